@@ -20,3 +20,33 @@ def create_open_directives(new_accounts, entries, meta_desc='<beancount_reds_plu
             open_entry = data.Open(meta, earliest_date, account_, None, None)
             new_open_entries.append(open_entry)
     return new_open_entries
+
+
+class AccountTrie:
+    """Map of account name prefixes to values, for looking up the longest prefix of an account
+    name. Prefixes are matched by whole components: 'Assets:Bank' is a prefix of
+    'Assets:Bank:Checking', but not of 'Assets:Banking'. A lookup costs one dict access per
+    component of the account name, whatever the number of prefixes."""
+
+    def __init__(self):
+        self.root = {}
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def insert(self, prefix, value):
+        node = self.root
+        for component in prefix.split(':'):
+            node = node.setdefault(component, {})
+        node[None] = value  # components are never empty, so None can't clash with them
+
+    def longest_prefix(self, account, default=None):
+        """Return the value of the longest prefix of account, or default if there isn't one."""
+        found = default
+        node = self.root
+        for component in account.split(':'):
+            node = node.get(component)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
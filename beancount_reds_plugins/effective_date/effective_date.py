@@ -1,10 +1,10 @@
 """Beancount plugin to implement per-posting effective dates. See README.md for more."""
 
 from ast import literal_eval
-import copy
+import collections
 import datetime
-import random
-import string
+import functools
+import hashlib
 import sys
 import time
 from beancount.core import data
@@ -16,7 +16,9 @@ __plugins__ = ['effective_date']
 # to enable the older transaction-level hacky plugin, now renamed to effective_date_transaction
 # __plugins__ = ['effective_date', 'effective_date_transaction']
 
-LINK_FORMAT = 'edate-{date}-{random}'
+LINK_FORMAT = 'edate-{date}-{id}'
+
+EffectiveDateError = collections.namedtuple('EffectiveDateError', 'source message entry')
 
 
 def has_valid_effective_date(posting):
@@ -32,22 +34,56 @@ def has_posting_with_valid_effective_date(entry):
     return False
 
 
-def create_new_effective_date_entry(entry, date, hold_posting, original_posting):
-    def cleaned(p):
-        clean_meta = copy.deepcopy(p.meta)
-        clean_meta.pop('effective_date', None)
-        return p._replace(meta=clean_meta)
-
-    new_meta = {'original_date': entry.date}
-    effective_date_entry = entry._replace(date=date, meta={**entry.meta, **new_meta},
-                                          postings=[cleaned(hold_posting), cleaned(original_posting)])
-    return effective_date_entry
+def without_effective_date(meta):
+    """Return a shallow copy of meta without its 'effective_date' key: a new dict, whose values
+    are shared with meta, which is left as is."""
+    if meta is None:
+        return None
+    return {key: value for key, value in meta.items() if key != 'effective_date'}
+
+
+def create_new_effective_date_entry(entry, date, posting_pairs, meta=None):
+    """Return a copy of entry on date, whose postings are each (hold_posting, original_posting) of
+    posting_pairs, stripped of their effective_date. meta is the new entry's metadata, by default
+    entry's with an original_date added. The new entry and each of its postings get their own
+    (shallow) copy of their metadata, so that later plugins can update them independently."""
+    if meta is None:
+        meta = {**entry.meta, 'original_date': entry.date}
+    postings = []
+    for hold_posting, original_posting in posting_pairs:
+        postings += [hold_posting._replace(meta=without_effective_date(hold_posting.meta)),
+                     original_posting._replace(meta=without_effective_date(original_posting.meta))]
+    return entry._replace(date=date, meta=dict(meta), postings=postings)
+
+
+def make_link(entry, used):
+    """Return a link for the set of entries created from entry. It's human readable:
+    edate-141215-3fa9c1 is for an entry on 2014-12-15, and 3fa9c1 is a hash of where the entry is
+    in the source, so that the link is the same on every run. used is the set of links made so
+    far, and is added to: if two entries hash alike, a counter is added to tell them apart."""
+    date = entry.date.strftime('%y%m%d')
+    location = '{}:{}'.format(entry.meta.get('filename'), entry.meta.get('lineno'))
+    digest = hashlib.blake2b(location.encode(), digest_size=3).hexdigest()
+    link = LINK_FORMAT.format(date=date, id=digest)
+    count = 1
+    while link in used:
+        count += 1
+        link = LINK_FORMAT.format(date=date, id='{}-{}'.format(digest, count))
+    used.add(link)
+    return link
 
 
 def build_config(config):
+    """Return (holding accounts, options) from config. Options are the keys that can't be account
+    names (they're lowercase): 'coalesce' (default False) creates one entry per effective date
+    and holding account of a transaction, rather than one per posting."""
     holding_accts = {}
     if config:
         holding_accts = literal_eval(config)
+    options = {'coalesce': False}
+    for key in options:
+        if key in holding_accts:
+            options[key] = holding_accts.pop(key)
     if not holding_accts:
         if DEBUG:
             print("effective_date: Using default config", file=sys.stderr)
@@ -55,7 +91,37 @@ def build_config(config):
                 'Expenses': {'earlier': 'Liabilities:Hold:Expenses', 'later': 'Assets:Hold:Expenses'},
                 'Income':   {'earlier': 'Assets:Hold:Income', 'later': 'Liabilities:Hold:Income'},
                 }
-    return holding_accts
+    return holding_accts, options
+
+
+class HoldingAccounts(dict):
+    """Map of account name -> (prefix, holding accounts) for the longest key of the config that
+    is a prefix of the account name (by whole components, so 'Expenses:Car' is a prefix of
+    'Expenses:Car:Insurance', but not of 'Expenses:Cards'), or None if there is no such key.
+
+    The keys are compiled into a trie, so a lookup costs one step per component of the account
+    name, however many keys there are. Each account name is looked up once, and memoized.
+    """
+
+    def __init__(self, holding_accts):
+        super().__init__()
+        self.trie = common.AccountTrie()
+        for prefix, accts in holding_accts.items():
+            self.trie.insert(prefix, (prefix, accts))
+
+    def __missing__(self, account):
+        value = self.trie.longest_prefix(account)
+        self[account] = value
+        return value
+
+
+@functools.lru_cache(maxsize=8)
+def compile_config(config):
+    """Return (HoldingAccounts, options) of build_config(config). This is cached, so that the config
+    is only parsed, and each account only looked up, once for as long as the config is unchanged
+    (eg: across reloads of a ledger by Fava)."""
+    holding_accts, options = build_config(config)
+    return HoldingAccounts(holding_accts), options
 
 
 def effective_date(entries, options_map, config):
@@ -66,14 +132,15 @@ def effective_date(entries, options_map, config):
       options_map: a dict of options parsed from the file
       config: A configuration string, which is intended to be a Python dict
         mapping match-accounts to a pair of (negative-account, position-account)
-        account names.
+        account names, and optionally the 'coalesce' option.
     Returns:
       A tuple of entries and errors.
 
     """
     start_time = time.time()
     errors = []
-    holding_accts = build_config(config)
+    holding_accts, options = compile_config(config)
+    coalesce = options['coalesce']
 
     interesting_entries = []
     filtered_entries = []
@@ -93,40 +160,46 @@ def effective_date(entries, options_map, config):
     # add a link to each effective date entry. this gets copied over to the newly created effective date
     # entries, and thus links each set of effective date entries
     interesting_entries_linked = []
+    used_links = set()
     for entry in interesting_entries:
-        rand_string = ''.join(random.choice(string.ascii_lowercase) for i in range(3))
-        date = str(entry.date).replace('-', '')[2:]
-        link = LINK_FORMAT.format(date=str(date), random=rand_string)
+        link = make_link(entry, used_links)
         new_entry = entry._replace(links=(entry.links or set()) | set([link]))
         interesting_entries_linked.append(new_entry)
 
     new_entries = []
     for entry in interesting_entries_linked:
         modified_entry_postings = []
-        for posting in entry.postings:
+        new_entry_meta = {**entry.meta, 'original_date': entry.date}  # copied into each entry created from entry
+        # (hold_posting, original_posting) pairs of each entry to create, in posting order. Keyed by
+        # (effective_date, holding_account) when coalescing, else by posting
+        groups = {}
+        for i, posting in enumerate(entry.postings):
             if not has_valid_effective_date(posting):
                 modified_entry_postings += [posting]
+            elif holding_accts[posting.account] is None:
+                errors.append(EffectiveDateError(
+                    entry.meta, "No effective_date holding account configured for {}".format(posting.account), entry))
+                modified_entry_postings.append(posting)
             else:
-                found_acct = ''
-                for acct in holding_accts:
-                    if posting.account.startswith(acct):
-                        found_acct = acct
+                found_acct, accts = holding_accts[posting.account]
 
                 # find earlier or later (is this necessary?)
-                holding_account = holding_accts[found_acct]['earlier']
+                holding_account = accts['earlier']
                 if posting.meta['effective_date'] > entry.date:
-                    holding_account = holding_accts[found_acct]['later']
+                    holding_account = accts['later']
 
                 # Replace posting in original entry with holding account
-                new_posting = posting._replace(account=posting.account.replace(found_acct, holding_account))
+                new_posting = posting._replace(account=holding_account + posting.account[len(found_acct):])
                 new_accounts.add(new_posting.account)
                 modified_entry_postings.append(new_posting)
 
                 # Create new entry at effective_date
                 hold_posting = new_posting._replace(units=-posting.units)
-                new_entry = create_new_effective_date_entry(entry, posting.meta['effective_date'],
-                                                            hold_posting, posting)
-                new_entries.append(new_entry)
+                date = posting.meta['effective_date']
+                key = (date, holding_account) if coalesce else i
+                groups.setdefault(key, (date, []))[1].append((hold_posting, posting))
+        for date, posting_pairs in groups.values():
+            new_entries.append(create_new_effective_date_entry(entry, date, posting_pairs, new_entry_meta))
         modified_entry = entry._replace(postings=modified_entry_postings)
         new_entries.append(modified_entry)
 
@@ -223,6 +296,7 @@ def effective_date_transaction(entries, options_map, config):
 
     modcount = 0
     new_entries = []
+    used_links = set()
     for entry in interesting_entries:
         modified_entry_postings = []
         effective_date_entry_postings = []
@@ -260,8 +334,7 @@ def effective_date_transaction(entries, options_map, config):
                 modified_entry_postings += [posting]
 
         if found:
-            rand_string = ''.join(random.choice(string.ascii_uppercase) for i in range(5))
-            link = LINK_FORMAT.format(rand_string)
+            link = make_link(entry, used_links)
             # modified_entry = data.entry_replace(entry, postings=modified_entry_postings,
             #                                     links=(entry.links or set()) | set([link]))
             modified_entry = entry._replace(postings=modified_entry_postings,
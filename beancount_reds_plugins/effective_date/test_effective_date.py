@@ -4,7 +4,7 @@ __license__ = "GNU GPLv3"
 import unittest
 import re
 
-from beancount_reds_plugins.effective_date.effective_date import effective_date
+from beancount_reds_plugins.effective_date.effective_date import effective_date, make_link
 from beancount.core import data
 from beancount.parser import options
 from beancount import loader
@@ -142,3 +142,128 @@ class TestEffectiveDate(unittest.TestCase):
 
         new_entries, _ = effective_date(entries, options_map, None)
         self.assertEqual(7, len(new_entries))
+
+    @loader.load_doc()
+    def test_longest_prefix_holding_account(self, entries, _, options_map):
+        """
+        2014-01-01 open Liabilities:Mastercard
+        2014-01-01 open Expenses:Taxes:Federal
+        2014-01-01 open Expenses:Taxesque
+        2014-01-01 open Assets:Prepaid
+
+        2014-02-01 * "Estimated taxes for 2013"
+          Liabilities:Mastercard    -2000 USD
+          Expenses:Taxes:Federal     1000 USD
+            effective_date: 2013-12-31
+          Expenses:Taxesque           900 USD
+            effective_date: 2013-12-31
+          Assets:Prepaid              100 USD
+            effective_date: 2013-12-31
+        """
+        config = """{
+            'Expenses:Taxes': {'earlier': 'Liabilities:Hold:Taxes', 'later': 'Assets:Hold:Taxes'},
+            'Expenses':       {'earlier': 'Liabilities:Hold:Expenses', 'later': 'Assets:Hold:Expenses'},
+            }"""
+        new_entries, errors = effective_date(entries, options_map, config)
+
+        original = [e for e in new_entries if isinstance(e, data.Transaction) and e.date == datetime.date(2014, 2, 1)]
+        self.assertEqual(['Liabilities:Mastercard', 'Liabilities:Hold:Taxes:Federal',
+                          'Liabilities:Hold:Expenses:Taxesque', 'Assets:Prepaid'],
+                         [p.account for p in original[0].postings])
+        self.assertEqual(1, len(errors))
+        self.assertIn('Assets:Prepaid', errors[0].message)
+
+    @loader.load_doc()
+    def test_metadata_copied_shallowly(self, entries, _, options_map):
+        """
+        2014-01-01 open Liabilities:Mastercard
+        2014-01-01 open Expenses:Car:Insurance
+
+        2014-02-01 * "Car insurance: 2 months"
+          Liabilities:Mastercard    -400 USD
+          Expenses:Car:Insurance     200 USD
+            effective_date: 2014-03-01
+            policy: "A-1"
+          Expenses:Car:Insurance     200 USD
+            effective_date: 2014-04-01
+        """
+        original_meta = dict(entries[-1].postings[1].meta)
+        new_entries, _ = effective_date(entries, options_map, None)
+
+        created = [e for e in new_entries if isinstance(e, data.Transaction) and 'original_date' in e.meta]
+        self.assertEqual(2, len(created))
+        self.assertIsNot(created[0].meta, created[1].meta)
+        hold, expense = created[0].postings
+        self.assertNotIn('effective_date', expense.meta)
+        self.assertIsNot(hold.meta, expense.meta)
+        created[0].meta['reviewed'] = True
+        hold.meta['reviewed'] = True
+        self.assertNotIn('reviewed', created[1].meta)
+        self.assertNotIn('reviewed', expense.meta)
+        self.assertEqual("A-1", expense.meta['policy'])
+        self.assertEqual(original_meta, entries[-1].postings[1].meta)
+
+    @loader.load_doc()
+    def test_links_deterministic_and_unique(self, entries, _, options_map):
+        """
+        2014-01-01 open Liabilities:Mastercard
+        2014-01-01 open Expenses:Car:Insurance
+
+        2014-02-01 * "Car insurance: March"
+          Liabilities:Mastercard    -200 USD
+          Expenses:Car:Insurance     200 USD
+            effective_date: 2014-03-01
+
+        2014-02-01 * "Car insurance: April"
+          Liabilities:Mastercard    -200 USD
+          Expenses:Car:Insurance     200 USD
+            effective_date: 2014-04-01
+        """
+        def links(new_entries):
+            return [e.links for e in new_entries if isinstance(e, data.Transaction)]
+
+        first = links(effective_date(entries, options_map, None)[0])
+        second = links(effective_date(entries, options_map, None)[0])
+        self.assertEqual(first, second)
+        self.assertEqual(2, len(set.union(*[set(ls) for ls in first])))
+        self.assertTrue(all(link.startswith('edate-140201-') for ls in first for link in ls))
+
+        # entries without a source location hash alike, but still get distinct links
+        used = set()
+        bare = entries[-1]._replace(meta={})
+        self.assertNotEqual(make_link(bare, used), make_link(bare, used))
+
+    @loader.load_doc()
+    def test_coalesce(self, entries, _, options_map):
+        """
+        2014-01-01 open Assets:Bank
+        2014-01-01 open Income:Salary
+        2014-01-01 open Expenses:Taxes:Federal
+        2014-01-01 open Expenses:Taxes:State
+        2014-01-01 open Expenses:Insurance
+
+        2014-01-03 * "Paycheck"
+          Income:Salary            -5000 USD
+          Expenses:Taxes:Federal    1000 USD
+            effective_date: 2013-12-31
+          Expenses:Taxes:State       500 USD
+            effective_date: 2013-12-31
+          Expenses:Insurance         100 USD
+            effective_date: 2014-02-01
+          Assets:Bank
+        """
+        config = "{'coalesce': True}"
+        new_entries, errors = effective_date(entries, options_map, config)
+        self.assertEqual([], errors)
+
+        created = [e for e in new_entries if isinstance(e, data.Transaction) and 'original_date' in e.meta]
+        self.assertEqual([datetime.date(2013, 12, 31), datetime.date(2014, 2, 1)], [e.date for e in created])
+        self.assertEqual(['Liabilities:Hold:Expenses:Taxes:Federal', 'Expenses:Taxes:Federal',
+                          'Liabilities:Hold:Expenses:Taxes:State', 'Expenses:Taxes:State'],
+                         [p.account for p in created[0].postings])
+        self.assertEqual(['Assets:Hold:Expenses:Insurance', 'Expenses:Insurance'],
+                         [p.account for p in created[1].postings])
+        self.assertEqual(created[0].links, created[1].links)
+
+        uncoalesced, _ = effective_date(entries, options_map, None)
+        self.assertEqual(len(new_entries) + 1, len(uncoalesced))
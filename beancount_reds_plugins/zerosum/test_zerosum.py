@@ -1,4 +1,9 @@
+import datetime
+import json
+import os
 import re
+import sqlite3
+import tempfile
 import unittest
 
 import beancount_reds_plugins.zerosum.zerosum as zerosum
@@ -259,6 +264,16 @@ class TestUnrealized(unittest.TestCase):
                          matched["Bank account"].postings[1].meta['match_id'])
         self.assertEqual(matched["Pay stub"].postings[2].meta['match_id'],
                          matched["401k statement"].postings[1].meta['match_id'])
+        self.assertNotEqual(matched["Pay stub"].postings[1].meta['match_id'],
+                            matched["Pay stub"].postings[2].meta['match_id'])
+
+        # match ids are the same on every run, and when streaming
+        new_config = config[:-2] + """'match_metadata': True,\n'link_transactions': True,\n}"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+        self.assertEqual(new_entries, zerosum.zerosum(entries, options_map, new_config)[0])
+        streamed = list(zerosum.zerosum_stream(entries, new_config))
+        self.assertEqual([e for e in new_entries if isinstance(e, data.Transaction)],
+                         [e for e in streamed if isinstance(e, data.Transaction)])
 
     @loader.load_doc()
     def test_match_name_successfully_changed(self, entries, _, options_map):
@@ -339,6 +354,10 @@ class TestUnrealized(unittest.TestCase):
         2024-02-16 * "401k statement"
           Assets:Brokerage:401k                          100.59 USD
           Assets:Zero-Sum-Accounts:401k
+
+        2024-02-20 * "Unrelated" ^trip
+          Income:Salary                                  -10.00 USD
+          Assets:Bank:Checkings
         """
         new_entries, _ = zerosum.zerosum(
             entries, options_map,
@@ -349,6 +368,9 @@ class TestUnrealized(unittest.TestCase):
              get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')])
 
         self.assertEqual(3, len(matched))
+        # only matched transactions are replaced, and links stay frozen
+        self.assertIs(entries[-1], new_entries[len(entries) - 1])
+        self.assertTrue(all(type(e.links) is frozenset for e in new_entries if isinstance(e, data.Transaction)))
 
         self.assertTrue(
             any(link.startswith("ZeroSum.") for link in (matched["Pay stub"].links & matched["Bank account"].links)))
@@ -478,3 +500,853 @@ class TestUnrealized(unittest.TestCase):
             any(link.startswith("ZSM") for link in (matched["Pay stub"].links & matched["401k statement"].links)))
         self.assertFalse(
             any(link.startswith("ZSM") for link in (matched["Bank account"].links & matched["401k statement"].links)))
+
+    @loader.load_doc()
+    def test_earliest_match_within_tolerance_wins(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-16 * "Near refund"
+          Liabilities:Credit-Cards:Green  -10.009 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-17 * "Exact refund"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-18 * "Too far off"
+          Liabilities:Credit-Cards:Green  10.01 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        new_entries, _ = zerosum.zerosum(entries, options_map, config)
+
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Purchase", "Near refund"], [m.narration for m in matched])
+
+    @loader.load_doc()
+    def test_account_patterns(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns
+        2015-01-01 open Assets:Zero-Sum-Accounts:Card-Payments
+        2015-01-01 open Assets:Bank:Transfers
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns
+
+        2015-06-25 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns
+
+        2015-06-15 * "Payment"
+          Liabilities:Credit-Cards:Green  30.00 USD
+          Assets:Zero-Sum-Accounts:Card-Payments
+
+        2015-06-25 * "Payment received"
+          Liabilities:Credit-Cards:Green  -30.00 USD
+          Assets:Zero-Sum-Accounts:Card-Payments
+
+        2015-06-15 * "Transfer out"
+          Liabilities:Credit-Cards:Green  40.00 USD
+          Assets:Bank:Transfers
+
+        2015-06-16 * "Transfer in"
+          Liabilities:Credit-Cards:Green  -40.00 USD
+          Assets:Bank:Transfers
+        """
+        new_config = """{
+         'zerosum_accounts' : {
+           'Assets:Zero-Sum-Accounts:*'             : ('', 30),
+           'Assets:Zero-Sum-Accounts:Card-Payments' : ('', 5),
+           're:Assets:(Bank|Broker):Transfers'      : ('Assets:Bank:Matched', 5),
+         },
+         'account_name_replace' : ('Zero-Sum-Accounts', 'ZSA-Matched'),
+        }"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched:Returns')
+        self.assertEqual(["Purchase", "Refund"], [m.narration for m in matched])
+        # the account name takes precedence over the pattern, with its shorter date range
+        self.assertEqual([], get_entries_with_acc_regexp(new_entries, ':ZSA-Matched:Card-Payments'))
+        matched = get_entries_with_acc_regexp(new_entries, 'Assets:Bank:Matched')
+        self.assertEqual(["Transfer out", "Transfer in"], [m.narration for m in matched])
+
+        opens = [e.account for e in new_entries if isinstance(e, data.Open)]
+        self.assertIn('Assets:ZSA-Matched:Returns', opens)
+        self.assertIn('Assets:Bank:Matched', opens)
+
+        zs_accounts = zerosum.ZerosumAccounts({'Assets:ZS:*': ('', 1), 'Assets:*:Transfers': ('', 2)}, ('ZS', 'M'))
+        self.assertEqual(zerosum.ZerosumAccount('Assets:M:A:B', 1, None), zs_accounts['Assets:ZS:A:B'])
+        self.assertIsNone(zs_accounts['Assets:ZS'])
+        self.assertIsNone(zs_accounts['Assets:ZSX:A'])
+        self.assertEqual(('Assets:Bank:Transfers', 2, None), zs_accounts['Assets:Bank:Transfers'])
+
+    @loader.load_doc()
+    def test_open_metadata_config(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+          zerosum_window: 5
+        2015-01-01 open Assets:Transfers
+          zerosum_window: 30
+          zerosum_target: "Assets:Transfers-Matched"
+          zerosum_tolerance: 0.02
+        2015-01-01 open Assets:Broken
+          zerosum_target: "Assets:Broken-Matched"
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-25 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Transfer out"
+          Liabilities:Credit-Cards:Green  40.00 USD
+          Assets:Transfers
+
+        2015-06-25 * "Transfer in"
+          Liabilities:Credit-Cards:Green  -39.99 USD
+          Assets:Transfers
+        """
+        new_entries, errors = zerosum.zerosum(entries, options_map, config)
+        self.assertEqual(1, len(errors))
+        self.assertIn('Assets:Broken', errors[0].message)
+
+        # the window in the metadata overrides the config's 90 days
+        self.assertEqual([], get_entries_with_acc_regexp(new_entries, ':ZSA-Matched'))
+        matched = get_entries_with_acc_regexp(new_entries, 'Assets:Transfers-Matched')
+        self.assertEqual(["Transfer out", "Transfer in"], [m.narration for m in matched])
+
+        streamed = list(zerosum.zerosum_stream(entries, config))
+        matched = get_entries_with_acc_regexp(streamed, 'Assets:Transfers-Matched')
+        self.assertEqual(["Transfer out", "Transfer in"], [m.narration for m in matched])
+
+        # the compiled config is reused as long as the Open entries are unchanged
+        open_accounts, _ = zerosum.open_accounts_config(entries)
+        self.assertIs(zerosum.compile_config(config, open_accounts), zerosum.compile_config(config, open_accounts))
+        self.assertIsNot(zerosum.compile_config(config, open_accounts), zerosum.compile_config(config))
+
+    @loader.load_doc()
+    def test_currencies_matched_separately(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase USD"
+          Liabilities:Credit-Cards:Green  -20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-16 * "Refund EUR"
+          Liabilities:Credit-Cards:Green  20.00 EUR
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-17 * "Purchase VMFXX"
+          Liabilities:Credit-Cards:Green  -20.000 VMFXX
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-18 * "Refund USD"
+          Liabilities:Credit-Cards:Green  20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-19 * "Refund VMFXX"
+          Liabilities:Credit-Cards:Green  20.005 VMFXX
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        # the EUR refund does not match the USD purchase
+        new_entries, _ = zerosum.zerosum(entries, options_map, config)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Purchase USD", "Purchase VMFXX", "Refund USD", "Refund VMFXX"],
+                         [m.narration for m in matched])
+
+        new_config = config[:-2] + """'currency_tolerance': {'VMFXX': 0.001},\n}"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Purchase USD", "Refund USD"], [m.narration for m in matched])
+
+        streamed = list(zerosum.zerosum_stream(entries, new_config))
+        self.assertEqual(["Purchase USD", "Refund USD"],
+                         [m.narration for m in get_entries_with_acc_regexp(streamed, ':ZSA-Matched')])
+
+    @loader.load_doc()
+    def test_match_groups(self, entries, _, options_map):
+        """
+        2015-01-01 open Assets:Bank
+        2015-01-01 open Assets:Brokerage
+        2015-01-01 open Assets:Zero-Sum-Accounts:Bank-Transfers
+        2015-01-01 open Assets:Zero-Sum-Accounts:Brokerage-Transfers
+
+        2015-06-15 * "Transfer out"
+          Assets:Bank  -500.00 USD
+          Assets:Zero-Sum-Accounts:Bank-Transfers
+
+        2015-06-17 * "Transfer in"
+          Assets:Brokerage  500.00 USD
+          Assets:Zero-Sum-Accounts:Brokerage-Transfers
+        """
+        group_config = """{
+         'zerosum_accounts' : {
+         'Assets:Zero-Sum-Accounts:Bank-Transfers'      : ('', 5),
+         'Assets:Zero-Sum-Accounts:Brokerage-Transfers' : ('', 5),
+          },
+          'account_name_replace' : ('Zero-Sum-Accounts', 'ZSA-Matched'),
+         }"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, group_config)
+        self.assertEqual([], get_entries_with_acc_regexp(new_entries, ':ZSA-Matched'))
+
+        group_config = group_config[:-2] + """'match_groups': [('Assets:Zero-Sum-Accounts:Bank-Transfers',
+                                           'Assets:Zero-Sum-Accounts:Brokerage-Transfers',
+                                           'Assets:Zero-Sum-Accounts:Unknown')],\n}"""
+        new_entries, errors = zerosum.zerosum(entries, options_map, group_config)
+        self.assertEqual(1, len(errors))
+        self.assertIn('Assets:Zero-Sum-Accounts:Unknown', errors[0].message)
+        expected = ['Assets:ZSA-Matched:Bank-Transfers', 'Assets:ZSA-Matched:Brokerage-Transfers']
+        self.assertEqual(expected, [e.postings[1].account for e in new_entries if isinstance(e, data.Transaction)])
+        self.assertEqual(expected, sorted(e.account for e in new_entries
+                                          if isinstance(e, data.Open) and 'ZSA-Matched' in e.account))
+
+        streamed = list(zerosum.zerosum_stream(entries, group_config))
+        self.assertEqual(expected, [e.postings[1].account for e in streamed if isinstance(e, data.Transaction)])
+
+    @loader.load_doc()
+    def test_input_entries_not_modified(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+          Liabilities:Credit-Cards:Green  10.00 USD
+
+        2015-06-16 * "Refund"
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+          Liabilities:Credit-Cards:Green  -10.00 USD
+        """
+        original = list(entries)
+        original_postings = [list(e.postings) for e in entries if isinstance(e, data.Transaction)]
+        new_config = config[:-2] + """'match_metadata': True,\n'link_transactions': True,\n}"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+
+        self.assertEqual(original, entries)
+        self.assertEqual(original_postings, [e.postings for e in entries if isinstance(e, data.Transaction)])
+        self.assertTrue(all(len(e.links) == 0 for e in entries if isinstance(e, data.Transaction)))
+
+        # matched postings keep their position in the transaction
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(2, len(matched))
+        for txn in matched:
+            self.assertEqual('Assets:ZSA-Matched:Returns-and-Temporary', txn.postings[0].account)
+            self.assertIn('match_id', txn.postings[0].meta)
+            self.assertEqual(1, len(txn.links))
+
+        # running again on the same input gives the same matches
+        new_entries, _ = zerosum.zerosum(entries, options_map, config)
+        self.assertEqual(2, len(get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')))
+
+    @loader.load_doc()
+    def test_closest_match_mode(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-01 * "Purchase never refunded"
+          Liabilities:Credit-Cards:Green  -50.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-10 * "Refund"
+          Liabilities:Credit-Cards:Green  50.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-11 * "Purchase"
+          Liabilities:Credit-Cards:Green  -50.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        # greedy matching would pair the refund with the first purchase
+        new_entries, errors = zerosum.zerosum(entries, options_map, config[:-2] + """'match_mode': 'closest',\n}""")
+        self.assertEqual([], errors)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Refund", "Purchase"], [m.narration for m in matched])
+
+        # closest first would pair (1, 2), then (0, 3), over a total of 7 days: greedy's 5 win
+        dates = [datetime.date(2015, 1, 1) + datetime.timedelta(days=d) for d in (0, 2, 3, 6)]
+        self.assertEqual([(0, 1), (2, 3)], zerosum.match_closest(dates, [10, -10, 10, -10], 10, 0.01))
+
+    @loader.load_doc()
+    def test_unknown_match_mode(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-01 * "Purchase"
+          Liabilities:Credit-Cards:Green  -50.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-10 * "Refund"
+          Liabilities:Credit-Cards:Green  50.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        new_entries, errors = zerosum.zerosum(entries, options_map, config[:-2] + """'match_mode': 'best',\n}""")
+        self.assertEqual(1, len(errors))
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(2, len(matched))
+
+    @loader.load_doc()
+    def test_subset_match(self, entries, _, options_map):
+        """
+        2015-01-01 open Assets:Bank
+        2015-01-01 open Assets:Brokerage-A
+        2015-01-01 open Assets:Brokerage-B
+        2015-01-01 open Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-01 * "Transfer out"
+          Assets:Bank  -20.00 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-03 * "Transfer in A"
+          Assets:Brokerage-A  12.50 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-03 * "Transfer in B"
+          Assets:Brokerage-B  7.50 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-04 * "Unrelated"
+          Assets:Brokerage-B  5.00 USD
+          Assets:Zero-Sum-Accounts:Checkings
+        """
+        new_entries, _ = zerosum.zerosum(entries, options_map, config[:-2] + """'max_subset_size': 3,\n}""")
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Transfer out", "Transfer in A", "Transfer in B"], [m.narration for m in matched])
+
+        # as with pairs, a match spans at most date_range days: +10 and -20 are within 10 days of
+        # each other, and so are -20 and +10, but not +10 and +10
+        dates = [datetime.date(2015, 1, 1) + datetime.timedelta(days=d) for d in (0, 10, 20)]
+        self.assertEqual([], zerosum.match_subsets(dates, [10, -20, 10], ['USD'] * 3, 10, 0.01, 2, set()))
+        self.assertEqual([(0, 1, 2)], zerosum.match_subsets(dates, [10, -20, 10], ['USD'] * 3, 20, 0.01, 2, set()))
+
+        # only the next MAX_SUBSET_CANDIDATES postings are searched
+        count = zerosum.MAX_SUBSET_CANDIDATES
+        dates = [datetime.date(2015, 1, 1)] * (count + 3)
+        numbers = [-3] + [100] * count + [1, 2]
+        self.assertEqual([], zerosum.match_subsets(dates, numbers, ['USD'] * len(numbers), 10, 0.01, 2, set()))
+        self.assertEqual([(0, count - 1, count)], zerosum.match_subsets(
+            dates[2:], numbers[:1] + numbers[3:], ['USD'] * (len(numbers) - 2), 10, 0.01, 2, set()))
+
+    @loader.load_doc()
+    def test_no_subset_match_by_default(self, entries, _, options_map):
+        """
+        2015-01-01 open Assets:Bank
+        2015-01-01 open Assets:Brokerage-A
+        2015-01-01 open Assets:Brokerage-B
+        2015-01-01 open Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-01 * "Transfer out"
+          Assets:Bank  -20.00 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-03 * "Transfer in A"
+          Assets:Brokerage-A  10.00 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2015-06-03 * "Transfer in B"
+          Assets:Brokerage-B  10.00 USD
+          Assets:Zero-Sum-Accounts:Checkings
+        """
+        new_entries, _ = zerosum.zerosum(entries, options_map, config)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual([], matched)
+
+    @loader.load_doc()
+    def test_parallel_workers(self, entries, _, options_map):
+        """
+        2023-01-01 open Income:Salary
+        2023-01-01 open Assets:Bank:Checkings
+        2023-01-01 open Assets:Zero-Sum-Accounts:Checkings
+        2023-01-01 open Assets:Brokerage:401k
+        2023-01-01 open Assets:Zero-Sum-Accounts:401k
+
+        2024-02-15 * "Pay stub"
+          Income:Salary                                -1100.06 USD
+          Assets:Zero-Sum-Accounts:Checkings             999.47 USD
+          Assets:Zero-Sum-Accounts:401k                  100.59 USD
+
+        2024-02-16 * "Bank account"
+          Assets:Bank:Checkings                          999.47 USD
+          Assets:Zero-Sum-Accounts:Checkings
+
+        2024-02-16 * "401k statement"
+          Assets:Brokerage:401k                          100.59 USD
+          Assets:Zero-Sum-Accounts:401k
+
+        2024-02-17 * "401k statement"
+          Assets:Brokerage:401k                          5.00 USD
+          Assets:Zero-Sum-Accounts:401k
+        """
+        new_entries, _ = zerosum.zerosum(entries, options_map, config[:-2] + """'workers': 2,\n}""")
+
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(3, len(matched))
+        unmatched = get_entries_with_acc_regexp(new_entries, ':Zero-Sum-Accounts:401k')
+        self.assertEqual(1, len(unmatched))
+        self.assertEqual(datetime.date(2024, 2, 17), unmatched[0].date)
+
+    @loader.load_doc()
+    def test_sharded_matching(self, entries, _, options_map):
+        """
+        2014-01-01 open Liabilities:Credit-Cards:Green
+        2014-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-01-01 * "Purchase 1"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-04-01 * "Refund 1"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-04-02 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-04-03 * "Refund 2"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        # the second shard starts on 2015-04-01, and on its own would match Refund 1 with Purchase 2
+        new_config = config[:-2] + """'workers': 2,\n'shard_days': 1,\n'match_metadata': True,\n}"""
+        stats = {}
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config, stats)
+        self.assertEqual(2, stats['accounts']['Assets:Zero-Sum-Accounts:Returns-and-Temporary']['shards'])
+        match_ids = [e.postings[1].meta['match_id'] for e in new_entries if isinstance(e, data.Transaction)]
+        self.assertEqual(4, len(get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')))
+        self.assertEqual([match_ids[0], match_ids[0], match_ids[2], match_ids[2]], match_ids)
+        self.assertNotEqual(match_ids[0], match_ids[2])
+
+        postings = [(datetime.date(2015, 1, 1) + datetime.timedelta(days=(i * 7) % 400), zerosum.Decimal(i % 3 - 1), 'USD')
+                    for i in range(300)]
+        postings.sort(key=lambda posting: posting[0])
+        bounds = zerosum.shard_bounds(postings, 10, 30)
+        self.assertLess(1, len(bounds))
+        shard_matches = [zerosum.match_account(postings[start:lookahead], 10, 0.01) for start, _, lookahead in bounds]
+        self.assertEqual(zerosum.match_account(postings, 10, 0.01),
+                         zerosum.merge_shards(postings, 10, 0.01, None, bounds, shard_matches))
+
+    @loader.load_doc()
+    def test_stream(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-23 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-07-01 * "Never refunded"
+          Liabilities:Credit-Cards:Green  -25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2016-01-01 * "Unrelated"
+          Liabilities:Credit-Cards:Green  -5.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        consumed = []
+
+        def source():
+            for entry in entries:
+                consumed.append(entry)
+                yield entry
+
+        stream = zerosum.zerosum_stream(source(), config)
+        new_entries = [next(stream) for _ in range(5)]
+        # the matched pair is yielded without reading further ahead
+        self.assertEqual(4, len(consumed))
+        self.assertEqual(["Purchase", "Refund"], [e.narration for e in new_entries[3:]])
+        # "Never refunded" is only known to be unmatched once we are 90 days past it
+        new_entries.append(next(stream))
+        self.assertEqual(len(entries), len(consumed))
+        new_entries += list(stream)
+
+        self.assertEqual(['Assets:ZSA-Matched:Returns-and-Temporary'],
+                         [e.account for e in new_entries if isinstance(e, data.Open) and 'ZSA' in e.account])
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Purchase", "Refund"], [m.narration for m in matched])
+        unmatched = get_entries_with_acc_regexp(new_entries, ':Zero-Sum-Accounts')
+        self.assertEqual(["Never refunded", "Unrelated"], [m.narration for m in unmatched])
+
+        # input entries are left untouched
+        self.assertEqual(0, len(get_entries_with_acc_regexp(entries, ':ZSA-Matched')))
+
+    def test_window_matcher_memory(self):
+        # a long stream of unique amounts, with every tenth posting refunded the next day: the
+        # matcher only holds the postings of the last date_range days
+        matcher = zerosum.WindowMatcher(5, 0.01)
+        start = datetime.date(2000, 1, 1)
+        expired = 0
+        for day in range(8000):
+            date = start + datetime.timedelta(days=day)
+            expired += len(matcher.expire(date))
+            matcher.add(date, day + 1, ('entry', day))
+            if day % 10 == 0:
+                self.assertEqual(('entry', day), matcher.add(date, -(day + 1), ('refund', day)))
+        self.assertEqual(7200 - 6, expired)
+        self.assertEqual(6, len(matcher.arrivals))
+        held = [posting for bucket in matcher.buckets.values() for posting in bucket]
+        self.assertLessEqual(len(held), 6)
+        self.assertTrue(all(posting[2] is not None for posting in held))
+
+    def test_match_cache(self):
+        ledger = """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-23 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-07-01 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        refund = """
+        2015-07-02 * "Refund 2"
+          Liabilities:Credit-Cards:Green  25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'zerosum.cache')
+            cached_config = config[:-2] + "'cache_file': {!r},\n}}".format(cache_file)
+
+            entries, _, options_map = loader.load_string(ledger)
+            new_entries, errors = zerosum.zerosum(entries, options_map, cached_config)
+            self.assertEqual([], errors)
+            self.assertTrue(os.path.exists(cache_file))
+            matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+            self.assertEqual(["Purchase", "Refund"], [m.narration for m in matched])
+
+            # the cache alone decides matches of unchanged postings
+            orig_match_account = zerosum.match_account
+            zerosum.match_account = None
+            try:
+                entries, _, options_map = loader.load_string(ledger)
+                new_entries, _ = zerosum.zerosum(entries, options_map, cached_config)
+            finally:
+                zerosum.match_account = orig_match_account
+            matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+            self.assertEqual(["Purchase", "Refund"], [m.narration for m in matched])
+
+            entries, _, options_map = loader.load_string(ledger + refund)
+            new_entries, _ = zerosum.zerosum(entries, options_map, cached_config)
+            matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+            self.assertEqual(["Purchase", "Refund", "Purchase 2", "Refund 2"], [m.narration for m in matched])
+
+            # a config change invalidates the cache
+            entries, _, options_map = loader.load_string(ledger + refund)
+            new_entries, _ = zerosum.zerosum(entries, options_map, cached_config.replace("('', 90)", "('', 5)"))
+            matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+            self.assertEqual(["Purchase 2", "Refund 2"], [m.narration for m in matched])
+
+    @loader.load_doc()
+    def test_flag_unmatched(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-18 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-07-01 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        new_config = config[:-2] + """'flag_unmatched': True,\n}"""
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+        self.assertIs(new_entries, zerosum._unmatched_handoff[0]())
+
+        flagged, _ = zerosum.flag_unmatched(new_entries, options_map, new_config)
+        self.assertIsNone(zerosum._unmatched_handoff)
+        self.assertEqual(["Purchase 2"], [e.narration for e in flagged if getattr(e, 'flag', None) == '!'])
+
+        # without zerosum's results, all entries are scanned
+        flagged, _ = zerosum.flag_unmatched(list(new_entries), options_map, new_config)
+        self.assertEqual(["Purchase 2"], [e.narration for e in flagged if getattr(e, 'flag', None) == '!'])
+
+        flagged, _ = zerosum.flag_unmatched(new_entries, options_map, config)
+        self.assertEqual([], [e.narration for e in flagged if getattr(e, 'flag', None) == '!'])
+
+        # the handoff doesn't keep the entries alive, and is cleared by the next zerosum() run
+        new_entries, _ = zerosum.zerosum(entries, options_map, new_config)
+        del new_entries
+        self.assertIsNone(zerosum._unmatched_handoff[0]())
+        zerosum.zerosum(entries, options_map, config)
+        self.assertIsNone(zerosum._unmatched_handoff)
+
+    @loader.load_doc()
+    def test_match_graph(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-18 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-07-01 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        graph = []
+        new_entries, _ = zerosum.zerosum(entries, options_map, config, graph=graph)
+        self.assertEqual(1, len(graph))
+        edge = graph[0]
+        self.assertEqual(3, edge.gap)
+        self.assertEqual((datetime.date(2015, 6, 15), datetime.date(2015, 6, 18)), (edge.first.date, edge.second.date))
+        self.assertEqual('Assets:Zero-Sum-Accounts:Returns-and-Temporary', edge.first.account)
+        self.assertEqual(-10, edge.second.number)
+        refund = [e for e in new_entries if isinstance(e, data.Transaction) and e.narration == "Refund"][0]
+        self.assertEqual((refund.meta['lineno'], 1), (edge.second.lineno, edge.second.index))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            match_db = os.path.join(tmpdir, 'matches.sqlite')
+            new_config = config[:-2] + "'match_db': {!r},\n}}".format(match_db)
+            _, errors = zerosum.zerosum(entries, options_map, new_config)
+            self.assertEqual([], errors)
+            connection = sqlite3.connect(match_db)
+            try:
+                match_id, = connection.execute(
+                    'SELECT match_id FROM matched_postings WHERE date = ? AND number = ?', ('2015-06-18', -10)).fetchone()
+                rows = connection.execute('SELECT date, number, gap FROM matched_postings WHERE match_id = ? '
+                                          'ORDER BY date', (match_id,)).fetchall()
+            finally:
+                connection.close()
+            self.assertEqual([('2015-06-15', '10', 3), ('2015-06-18', '-10', 3)], rows)
+
+            # amounts are stored exactly
+            number = zerosum.Decimal('1234567.123456789123456789')
+            ref = edge.first._replace(number=number)
+            zerosum.export_match_graph(match_db, [edge._replace(first=ref, second=ref._replace(number=-number, index=9))])
+            connection = sqlite3.connect(match_db)
+            try:
+                rows = connection.execute('SELECT number FROM matched_postings WHERE currency = ?',
+                                          (ref.currency,)).fetchall()
+            finally:
+                connection.close()
+            self.assertEqual({(str(number),), (str(-number),)}, set(rows))
+
+    @loader.load_doc()
+    def test_auto_window(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-01 * "Purchase 1"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-02 * "Refund 1"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-10 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-11 * "Refund 2"
+          Liabilities:Credit-Cards:Green  20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-20 * "Purchase 3"
+          Liabilities:Credit-Cards:Green  -30.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-25 * "Refund 3"
+          Liabilities:Credit-Cards:Green  30.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        self.assertEqual(1, zerosum.learned_date_range(
+            [datetime.date(2015, 6, d) for d in (1, 2, 10, 11, 20, 25)], [(0, 1), (2, 3), (4, 5)], 50))
+
+        new_config = config[:-2] + "'auto_window': 'report',\n'auto_window_percentile': 50,\n}"
+        new_entries, errors = zerosum.zerosum(entries, options_map, new_config)
+        self.assertEqual(6, len(get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')))
+        self.assertEqual(["Zerosum account Assets:Zero-Sum-Accounts:Returns-and-Temporary: 50% of its matches "
+                          "are within 1 days, but its date range is 90 days"], [e.message for e in errors])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'zerosum.cache')
+            new_config = new_config[:-2] + "'auto_window': 'apply',\n'cache_file': {!r},\n}}".format(cache_file)
+
+            # the first run learns the date range, the next ones apply it
+            for expected in (6, 4, 4):
+                stats = {}
+                new_entries, errors = zerosum.zerosum(entries, options_map, new_config, stats)
+                self.assertEqual([], errors)
+                self.assertEqual(expected, len(get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')))
+                account_stats = stats['accounts']['Assets:Zero-Sum-Accounts:Returns-and-Temporary']
+                self.assertEqual(1, account_stats['learned_date_range'])
+
+            # 'report' learns from the current matches on every run, even with a cache
+            new_config = config[:-2] + "'auto_window': 'report',\n'auto_window_percentile': 100,\n" \
+                "'cache_file': {!r},\n}}".format(cache_file + '.report')
+            for ledger, days in ((entries[:6], 1), (entries, 5)):
+                _, errors = zerosum.zerosum(ledger, options_map, new_config)
+                self.assertEqual(["Zerosum account Assets:Zero-Sum-Accounts:Returns-and-Temporary: 100% of its "
+                                  "matches are within {} days, but its date range is 90 days".format(days)],
+                                 [e.message for e in errors])
+
+    @loader.load_doc()
+    def test_match_budget(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-01 * "Purchase 1"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-02 * "Refund 1"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-10 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-11 * "Refund 2"
+          Liabilities:Credit-Cards:Green  20.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        for engine in ('python', 'numpy'):
+            new_config = config[:-2] + "'max_comparisons': 1,\n'engine': {!r},\n}}".format(engine)
+            new_entries, errors = zerosum.zerosum(entries, options_map, new_config)
+            matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+            self.assertEqual(["Purchase 1", "Refund 1"], [m.narration for m in matched])
+            self.assertEqual(["Zerosum account Assets:Zero-Sum-Accounts:Returns-and-Temporary: matching ran out of "
+                              "budget after 1 comparisons; its postings from 2015-06-10 on were not looked at, and "
+                              "may be left unmatched"], [e.message for e in errors])
+
+        # closest mode keeps the pairs greedy found before the budget ran out
+        new_config = config[:-2] + "'max_comparisons': 1,\n'match_mode': 'closest',\n}"
+        new_entries, errors = zerosum.zerosum(entries, options_map, new_config)
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(["Purchase 1", "Refund 1"], [m.narration for m in matched])
+        self.assertIn('after 1 comparisons; its postings from 2015-06-10 on', errors[0].message)
+
+        # a budget that greedy doesn't exhaust isn't charged again by closest mode
+        dates = [datetime.date(2015, 1, 1) + datetime.timedelta(days=i) for i in range(6)]
+        budget = zerosum.MatchBudget(max_comparisons=3)
+        pairs = zerosum.match_closest(dates, [10, -10, 20, -20, 30, -30], 30, 0.01, budget=budget)
+        self.assertEqual([(0, 1), (2, 3), (4, 5)], pairs)
+        self.assertIsNone(budget.stopped_at)
+
+        new_config = config[:-2] + "'max_milliseconds': 0,\n'match_mode': 'closest',\n}"
+        new_entries, errors = zerosum.zerosum(entries, options_map, new_config)
+        self.assertEqual([], get_entries_with_acc_regexp(new_entries, ':ZSA-Matched'))
+        self.assertIn('postings from 2015-06-01 on', errors[0].message)
+
+        # subset searches stop midway too: no subset of even amounts sums up to an odd one
+        dates = [datetime.date(2015, 1, 1)] * 300
+        numbers = [1] + [2 * i * (-1) ** i for i in range(1, 300)]
+        budget = zerosum.MatchBudget(max_comparisons=1000)
+        matches = zerosum.match_subsets(dates, numbers, ['USD'] * 300, 90, 0.01, 4, set(), budget)
+        self.assertEqual([], matches)
+        self.assertEqual(datetime.date(2015, 1, 1), budget.stopped_at)
+        self.assertLess(budget.comparisons, 1000 + 2 * len(numbers))
+
+        new_config = config[:-2] + "'max_comparisons': 10,\n}"
+        new_entries, errors = zerosum.zerosum(entries, options_map, new_config)
+        self.assertEqual([], errors)
+        self.assertEqual(4, len(get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')))
+
+    @loader.load_doc()
+    def test_stats(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-15 * "Purchase"
+          Liabilities:Credit-Cards:Green  -10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-18 * "Refund"
+          Liabilities:Credit-Cards:Green  10.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-07-01 * "Purchase 2"
+          Liabilities:Credit-Cards:Green  -25.00 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        stats = {}
+        zerosum.zerosum(entries, options_map, config, stats=stats)
+        self.assertEqual(3, stats['postings'])
+        self.assertEqual(2, stats['matched_postings'])
+        self.assertEqual({'collect', 'match', 'apply', 'open'}, set(stats['timings']))
+
+        account_stats = stats['accounts']['Assets:Zero-Sum-Accounts:Returns-and-Temporary']
+        self.assertEqual(3, account_stats['candidates'])
+        self.assertEqual(1, account_stats['matches'])
+        self.assertEqual({3: 1}, account_stats['match_gap_days'])
+        self.assertEqual({0: 1, 1: 1, 2: 1}, account_stats['window_sizes'])
+        self.assertEqual({0: 1, 1: 1}, account_stats['scanned'])
+        self.assertEqual(0, stats['accounts']['Assets:Zero-Sum-Accounts:Checkings']['candidates'])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats_file = os.path.join(tmpdir, 'stats.json')
+            os.environ[zerosum.STATS_ENV_VAR] = stats_file
+            try:
+                zerosum.zerosum(entries, options_map, config)
+            finally:
+                del os.environ[zerosum.STATS_ENV_VAR]
+            with open(stats_file) as f:
+                self.assertEqual(2, json.load(f)['matched_postings'])
+
+    @loader.load_doc()
+    def test_numpy_engine(self, entries, _, options_map):
+        """
+        2015-01-01 open Liabilities:Credit-Cards:Green
+        2015-01-01 open Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        2015-06-15 * "Expensive furniture"
+          Liabilities:Credit-Cards:Green  -2526.02 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary             1263.01 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary             1263.01 USD
+
+        2015-06-16 * "Near refund"
+          Liabilities:Credit-Cards:Green  1263.0199 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-23 * "Expensive furniture Refund"
+          Liabilities:Credit-Cards:Green  1263.015 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+
+        2015-06-23 * "Expensive furniture Refund"
+          Liabilities:Credit-Cards:Green  1263.01 USD
+          Assets:Zero-Sum-Accounts:Returns-and-Temporary
+        """
+        # works (by falling back to the python engine) even if numpy isn't installed
+        new_entries, _ = zerosum.zerosum(entries, options_map, config[:-2] + """'engine': 'numpy',\n}""")
+
+        matched = get_entries_with_acc_regexp(new_entries, ':ZSA-Matched')
+        self.assertEqual(3, len(matched))
+        self.assertEqual("Near refund", get_entries_with_acc_regexp(new_entries, ':Zero-Sum-Accounts')[0].narration)
@@ -103,7 +103,8 @@ The following examples will be matched and moved by this plugin:
       Assets:TB_Trading_B  10 USD
       ZeroSumAccount:Transfers
 
-The following examples will NOT be matched:
+The following examples will NOT be matched (both will be, when 'max_subset_size' is 2 or
+more. See below):
 
     Example A:
     ----------
@@ -154,20 +155,43 @@ of accounts on which the plugin should operate. The values are
 the plugin should move matched postings, and the date_range is the range over
 which to check for matches for that account.
 
+Zerosum accounts can also be configured with metadata on their Open directives, which
+takes precedence over the plugin's config for that account:
+
+    2005-01-01 open Assets:Zero-Sum-Accounts:Bank-Account-Transfers
+      zerosum_window: 30
+      zerosum_target: "Assets:ZSA-Matched:Bank-Account-Transfers"
+      zerosum_tolerance: 0.01
+
+zerosum_window is the date_range, and is required. zerosum_target is optional, as above.
+zerosum_tolerance optionally replaces 'tolerance' (see below) for the account, while
+'currency_tolerance' still applies on top of it.
+
 TODO:
-- allow config using account metadata
-- take plugin params from metadata (including date_range)
 - optionally create a linking metadata (or a beancount-link) between matches
 
 """
 
+import bisect
+import collections
+import concurrent.futures
 import datetime
-import random
-import string
+import fnmatch
+import functools
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
 import time
+import types
+import weakref
 
 from ast import literal_eval
 from collections import defaultdict
+from decimal import Decimal, ROUND_FLOOR
 
 from beancount.core import data
 from beancount.core import flags
@@ -177,35 +201,1387 @@ DEBUG = 0
 DEFAULT_TOLERANCE = 0.0099
 MATCHING_ID_STRING = "match_id"
 LINK_PREFIX = "ZeroSum."
-random.seed(6)  # arbitrary fixed seed
+CACHE_VERSION = 4
+# Maximum number of postings searched for subsets that sum up to zero with a posting. See match_subsets()
+MAX_SUBSET_CANDIDATES = 40
+STATS_ENV_VAR = 'ZEROSUM_STATS'
 
 __plugins__ = ('zerosum', 'flag_unmatched',)
 
+ZerosumError = collections.namedtuple('ZerosumError', 'source message entry')
+
+# Configuration of a zerosum account. tolerance is None unless set in its Open metadata
+ZerosumAccount = collections.namedtuple('ZerosumAccount', 'target_account date_range tolerance')
+
+# Match graph (see zerosum()): a posting is referred to by the location of its transaction and its
+# index in it, and account is the zerosum account it was matched in
+PostingRef = collections.namedtuple('PostingRef', 'filename lineno index date account number currency')
+MatchEdge = collections.namedtuple('MatchEdge', 'match_id first second gap')
+
+# (weak reference to the entries returned by the last zerosum() run, indexes of its transactions
+# with unmatched postings), handed off to flag_unmatched(), which runs right after it, so it needn't
+# scan the whole ledger. The reference is weak, so that the handoff never keeps a ledger in memory
+_unmatched_handoff = None
+
+
+class _Entries(list):
+    """The list of entries returned by zerosum(): a list that can be weakly referenced."""
+    __slots__ = ('__weakref__',)
+
+
+DEFAULT_CONFIG = {
+    'zerosum_accounts': {},
+    'account_name_replace': ('', ''),
+    'tolerance': DEFAULT_TOLERANCE,
+    'currency_tolerance': {},
+    'flag_unmatched': False,
+    'match_metadata': False,
+    'match_metadata_name': MATCHING_ID_STRING,
+    'link_transactions': False,
+    'link_prefix': LINK_PREFIX,
+    'match_mode': 'greedy',
+    'max_subset_size': 1,
+    'workers': 0,
+    'cache_file': None,
+    'engine': 'python',
+    'match_db': None,
+    'match_groups': [],
+    'auto_window': None,
+    'auto_window_percentile': 99,
+    'max_comparisons': None,
+    'max_milliseconds': None,
+    'shard_days': None,
+}
+
+
+class ZerosumAccounts(dict):
+    """Map of account name -> ZerosumAccount if the account is a zerosum account, or None if
+    it isn't, built from the 'zerosum_accounts' config.
+
+    Keys of 'zerosum_accounts' can be account names, or patterns matching several accounts:
+    - 'Assets:Zero-Sum-Accounts:*' for all accounts under Assets:Zero-Sum-Accounts
+    - other glob patterns, eg: 'Assets:*:Transfers'
+    - regular expressions matching the whole account name, prefixed with 're:', eg:
+      're:Assets:(Bank|Broker):Transfers'
+    Target accounts left blank are derived from each account's name, using
+    'account_name_replace'. Each account matching a pattern is matched on its own.
+
+    Account names take precedence, then the longest 'Prefix:*' pattern (looked up in a trie),
+    then other patterns, in config order. Each account name is classified on first lookup and
+    memoized, so always look up accounts with [], rather than 'in' or get(), and iterate over
+    'named' rather than over this.
+    """
+
+    def __init__(self, config, account_name_replace):
+        super().__init__()
+        self.config = config
+        self.account_name_replace = account_name_replace
+        self.prefixes = common.AccountTrie()
+        self.patterns = []  # (compiled regex, target_account, date_range)
+        self.named = {}     # accounts configured by name, in order (the values are unused)
+        for key, (target_account, date_range) in config.items():
+            if key.startswith('re:'):
+                self.patterns.append((re.compile(key[3:]), target_account, date_range))
+            elif key.endswith(':*') and not any(c in key[:-2] for c in '*?['):
+                self.prefixes.insert(key[:-2], (target_account, date_range))
+            elif any(c in key for c in '*?['):
+                self.patterns.append((re.compile(fnmatch.translate(key)), target_account, date_range))
+            else:
+                self.add(key, target_account, date_range)
+
+    def _resolve(self, account, target_account, date_range, tolerance=None):
+        account_name_from, account_name_to = self.account_name_replace
+        return ZerosumAccount(target_account or account.replace(account_name_from, account_name_to), date_range,
+                              tolerance)
+
+    def add(self, account, target_account, date_range, tolerance=None):
+        """Make account a zerosum account, overriding the config."""
+        self[account] = self._resolve(account, target_account, date_range, tolerance)
+        self.named[account] = None
+
+    def __missing__(self, account):
+        found = self.prefixes.longest_prefix(account.rpartition(':')[0]) if self.prefixes else None
+        if found is None:
+            found = next(((target_account, date_range) for regex, target_account, date_range in self.patterns
+                          if regex.fullmatch(account)), None)
+        value = self._resolve(account, *found) if found is not None else None
+        self[account] = value
+        return value
+
+
+def build_config(config):
+    """Parse the plugin's config string, and fill in defaults for missing options.
+    'zerosum_accounts' is compiled into a ZerosumAccounts."""
+    options = dict(DEFAULT_CONFIG)
+    if config:
+        options.update(literal_eval(config))  # TODO: error check
+    options['zerosum_accounts'] = ZerosumAccounts(options['zerosum_accounts'], options['account_name_replace'])
+    options['open_accounts'] = ()
+    return options
+
+
+OPEN_METADATA = ('zerosum_target', 'zerosum_window', 'zerosum_tolerance')
+
+
+def open_entry_config(entry):
+    """Return the zerosum config in the metadata of an Open entry, as a tuple of (account,
+    target_account, date_range, tolerance), or None if it has none. Raises ValueError if the
+    metadata is invalid."""
+    meta = entry.meta
+    if not meta or not any(key in meta for key in OPEN_METADATA):
+        return None
+    try:
+        date_range = int(meta['zerosum_window'])
+        tolerance = meta.get('zerosum_tolerance')
+        if tolerance is not None:
+            tolerance = Decimal(str(tolerance))
+    except (KeyError, TypeError, ValueError, ArithmeticError):
+        raise ValueError("Invalid zerosum metadata on account {}: 'zerosum_window' must be a number of days, "
+                         "and 'zerosum_tolerance' a number".format(entry.account))
+    return (entry.account, str(meta.get('zerosum_target', '')), date_range, tolerance)
+
+
+def open_accounts_config(entries):
+    """Collect the zerosum config in the metadata of all Open entries. Returns a tuple of
+    open_entry_config() results, and a list of errors."""
+    accounts, errors = [], []
+    for entry in entries:
+        if isinstance(entry, data.Open):
+            try:
+                account_config = open_entry_config(entry)
+            except ValueError as err:
+                errors.append(ZerosumError(entry.meta, str(err), entry))
+                continue
+            if account_config is not None:
+                accounts.append(account_config)
+    return tuple(accounts), errors
+
+
+@functools.lru_cache(maxsize=8)
+def compile_config(config, open_accounts=()):
+    """Return build_config(config), with the zerosum accounts configured in Open metadata
+    (see open_accounts_config()) added. The result is cached, so that as long as the config
+    string and the Open entries are unchanged (eg: across reloads of a ledger by Fava), the
+    config is only parsed once, and each account is only classified once. It is read-only."""
+    options = build_config(config)
+    for account_config in open_accounts:
+        options['zerosum_accounts'].add(*account_config)
+    options['open_accounts'] = open_accounts
+    return types.MappingProxyType(options)
+
+
+def match_groups(options):
+    """Compile 'match_groups' (see zerosum()). Returns a dict of zerosum account -> the name
+    of its group, a dict of group name -> ZerosumAccount for the group, and a list of errors.
+    A group's date range is the largest of its accounts', and its tolerance the smallest; it
+    has no target account, since matched postings move to their own account's target."""
+    zs_accounts = options['zerosum_accounts']
+    group_of, groups, errors = {}, {}, []
+    for accounts in options['match_groups']:
+        members = []
+        for account in accounts:
+            if zs_accounts[account] is None:
+                errors.append("Account {} in zerosum match_groups is not a zerosum account".format(account))
+            elif account in group_of:
+                errors.append("Account {} is in several zerosum match_groups".format(account))
+            else:
+                members.append(account)
+        if len(members) < 2:
+            continue
+        name = ' + '.join(members)
+        tolerances = [zs_accounts[account].tolerance for account in members
+                      if zs_accounts[account].tolerance is not None]
+        groups[name] = ZerosumAccount(None, max(zs_accounts[account].date_range for account in members),
+                                      min(tolerances) if tolerances else None)
+        group_of.update((account, name) for account in members)
+    return group_of, groups, [ZerosumError(data.new_metadata('<zerosum>', 0), message, None) for message in errors]
+
+
+def _bucket_key(number, width):
+    """Quantize number to a multiple of width."""
+    return int((number / width).to_integral_value(rounding=ROUND_FLOOR))
+
+
+class AmountIndex:
+    """Index of the postings of a zerosum account, for fast match lookup.
+
+    Postings are identified by their sequence number (their position in the date-sorted
+    list handed to the constructor). They are bucketed by their amount quantized to the
+    tolerance, so every posting that can cancel out a given amount lives in one of three
+    neighbouring buckets. Each bucket holds a sorted list of sequence numbers (and thus is
+    also sorted by date), which lets us bisect to the start of the search, instead of
+    scanning every posting in the date window.
+
+    Matched postings are removed lazily: each bucket keeps a union-find style 'skip' list
+    that points past removed postings, so repeatedly matching identical amounts stays cheap.
+
+    If scanned is a Counter, it is updated with the number of postings compared by each find().
+    If budget is a MatchBudget, the comparisons are charged to it.
+    """
+
+    def __init__(self, dates, numbers, tolerance, scanned=None, budget=None):
+        self.dates = dates
+        self.numbers = numbers
+        self.tolerance = tolerance
+        self.scanned = scanned
+        self.budget = budget
+        self.width = Decimal(str(tolerance)) if tolerance > 0 else None
+        self.buckets = {}    # bucket key -> (sorted list of seqs, skip list)
+        self.location = []   # seq -> (bucket key, position in the bucket)
+        self.matched = bytearray(len(numbers))
+        if self.width is None:
+            return
+        for seq, number in enumerate(numbers):
+            key = self.bucket_key(number)
+            seqs, skip = self.buckets.setdefault(key, ([], [0]))
+            self.location.append((key, len(seqs)))
+            seqs.append(seq)
+            skip.append(len(skip))
+
+    def bucket_key(self, number):
+        return _bucket_key(number, self.width)
+
+    @staticmethod
+    def _next(skip, pos):
+        """Return the first position at or after pos that has not been removed."""
+        root = pos
+        while skip[root] != root:
+            root = skip[root]
+        while skip[pos] != root:  # path compression
+            skip[pos], pos = root, skip[pos]
+        return root
+
+    def remove(self, seq):
+        self.matched[seq] = 1
+        if self.width is not None:
+            key, pos = self.location[seq]
+            self.buckets[key][1][pos] = pos + 1
+
+    def find(self, seq, max_date):
+        """Return the earliest unmatched posting after seq, dated on or before max_date,
+        that sums up to zero (within tolerance) with posting seq. None if there isn't one."""
+        if self.width is None:
+            return None
+        number = self.numbers[seq]
+        limit = bisect.bisect_right(self.dates, max_date)
+        target = self.bucket_key(-number)
+        best = None
+        scanned = 0
+        for key in (target - 1, target, target + 1):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            seqs, skip = bucket
+            pos = self._next(skip, bisect.bisect_right(seqs, seq))
+            while pos < len(seqs) and seqs[pos] < limit and (best is None or seqs[pos] < best):
+                scanned += 1
+                if abs(self.numbers[seqs[pos]] + number) < self.tolerance:
+                    best = seqs[pos]
+                    break
+                pos = self._next(skip, pos + 1)
+        if self.scanned is not None:
+            self.scanned[scanned] += 1
+        if self.budget is not None:
+            self.budget.comparisons += scanned
+        return best
+
+
+class MatchBudget:
+    """Limit on the work spent matching a zerosum account, so that pathological inputs (eg:
+    many identical amounts in a long date range) can't hold up loading a ledger: at most
+    max_comparisons postings compared, and max_milliseconds spent (None for no limit).
+
+    Matchers add the postings they compare to 'comparisons', and check exceeded() before
+    looking for a match for each posting. Once it returns True, they stop, leaving the rest of
+    the postings unmatched. 'stopped_at' is the date of the earliest posting left unexamined.
+    """
 
-# replace the account on a given posting with a new account
-def account_replace(txn, posting, new_account):
-    # create a new posting with the new account, then remove old and add new
-    # from parent transaction
-    new_posting = posting._replace(account=new_account)
-    txn.postings.remove(posting)
-    txn.postings.append(new_posting)
+    def __init__(self, max_comparisons=None, max_milliseconds=None):
+        self.max_comparisons = max_comparisons
+        self.max_milliseconds = max_milliseconds
+        self.comparisons = 0
+        self.deadline = None
+        self.stopped_at = None
+
+    def start(self):
+        """Start the clock. Called when matching starts, which may be in a worker process."""
+        if self.max_milliseconds is not None:
+            self.deadline = time.time() + self.max_milliseconds / 1000
+
+    def used_up(self):
+        """Return whether the budget is used up, for checks in the middle of a search."""
+        return ((self.max_comparisons is not None and self.comparisons >= self.max_comparisons) or
+                (self.deadline is not None and time.time() >= self.deadline))
+
+    def exceeded(self, date):
+        """Return whether the budget is used up, recording date as where matching stopped if
+        it is."""
+        if self.used_up():
+            if self.stopped_at is None or date < self.stopped_at:
+                self.stopped_at = date
+            return True
+        return False
+
+
+class WindowMatcher:
+    """Greedy matcher for a zerosum account and currency over a sliding window of open (not yet matched)
+    postings, for use on a stream of date-sorted entries.
+
+    Each new posting is matched against the earliest open posting that sums up to zero with it,
+    and is kept open otherwise. Postings are dropped from the window, and reported as
+    unmatched, as soon as the stream moves more than date_range days past them. As with
+    AmountIndex, open postings are bucketed by their amount quantized to the tolerance.
+
+    Closed (matched or expired) postings drop their ref right away, and are pruned from the
+    front of their bucket as they leave the window, so the matcher only ever holds the
+    postings of the last date_range days, however long the stream.
+    """
+
+    def __init__(self, date_range, tolerance):
+        self.window = datetime.timedelta(days=date_range)
+        self.tolerance = tolerance
+        self.width = Decimal(str(tolerance)) if tolerance > 0 else None
+        self.buckets = defaultdict(collections.deque)  # bucket key -> deque of open postings
+        self.arrivals = collections.deque()            # open postings, in date order
+        self.count = 0
+
+    def expire(self, date):
+        """Close the postings that can't be matched by a posting dated date or later, and
+        return their refs."""
+        expired = []
+        while self.arrivals and self.arrivals[0][0] + self.window < date:
+            posting = self.arrivals.popleft()
+            if posting[3]:
+                expired.append(self._close(posting))
+            if self.width is not None:
+                # buckets are in arrival order too: the postings before this one have left the
+                # window already, so this one is at the front, after closed ones
+                bucket = self.buckets[posting[5]]
+                while bucket and not bucket[0][3]:
+                    bucket.popleft()
+                if not bucket:
+                    del self.buckets[posting[5]]
+        return expired
+
+    @staticmethod
+    def _close(posting):
+        """Close posting, and return its ref, which it no longer holds."""
+        ref = posting[2]
+        posting[2], posting[3] = None, False
+        return ref
+
+    def add(self, date, number, ref):
+        """Add a posting. Returns the ref of the open posting it matched and closed, or None if
+        there was no match, in which case the new posting is kept open."""
+        if self.width is not None:
+            best = None
+            target = _bucket_key(-number, self.width)
+            for key in (target - 1, target, target + 1):
+                bucket = self.buckets.get(key)
+                while bucket and not bucket[0][3]:
+                    bucket.popleft()
+                for posting in bucket or ():
+                    if posting[3] and posting[0] + self.window >= date and abs(posting[1] + number) < self.tolerance:
+                        if best is None or posting[4] < best[4]:
+                            best = posting
+                        break
+            if best is not None:
+                return self._close(best)
+
+        key = _bucket_key(number, self.width) if self.width is not None else None
+        posting = [date, number, ref, True, self.count, key]  # open flag, arrival order, bucket key
+        self.count += 1
+        if self.width is not None:
+            self.buckets[key].append(posting)
+        self.arrivals.append(posting)
+        return None
 
 
-def metadata_update(txn, posting, match_id, matching_id_string):
-    if match_id and matching_id_string:
-        if posting.meta:
-            # Will overwrite an existing match (shouldn't exist)
-            posting.meta.update({matching_id_string: match_id})
+def match_greedy(dates, numbers, date_range, tolerance, start=0, settled=(), scanned=None, budget=None):
+    """Pair each posting, in date order, with the earliest unmatched posting at most date_range
+    days later that sums up to zero with it.
+
+    Args:
+      dates: list of posting dates, sorted
+      numbers: list of posting amounts, in the same order as dates
+      date_range: maximum number of days between matched postings
+      tolerance: the maximum cost difference between two matching postings
+      start: resume matching from this posting, taking the postings before it as decided
+      settled: the pairs already found for the postings before start
+      scanned: optional Counter of the number of postings compared per lookup. See AmountIndex
+      budget: optional MatchBudget to stop at, leaving the remaining postings unmatched
+    Returns:
+      A list of (seq, seq) pairs of matched postings, indexing into dates/numbers.
+    """
+    index = AmountIndex(dates, numbers, tolerance, scanned, budget)
+    window = datetime.timedelta(days=date_range)
+    pairs = [tuple(pair) for pair in settled]
+    for pair in pairs:
+        for seq in pair:
+            index.remove(seq)
+    for seq in range(start, len(numbers)):
+        if index.matched[seq]:
+            continue
+        if budget is not None and budget.exceeded(dates[seq]):
+            break
+        match_seq = index.find(seq, dates[seq] + window)
+        if match_seq is not None:
+            index.remove(seq)
+            index.remove(match_seq)
+            pairs.append((seq, match_seq))
+    return pairs
+
+
+def _scale_to_integers(numbers, tolerance):
+    """Scale numbers to integers (eg: to cents), and the tolerance to the largest integer distance
+    that is within it. Returns (list of integers, distance), or None if the integers would not
+    fit in 64 bits."""
+    places = max([-number.as_tuple().exponent for number in numbers] + [0])
+    scaled = [int(number.scaleb(places)) for number in numbers]
+    if places > 18 or any(abs(number) >= 2**62 for number in scaled):
+        return None
+    scaled_tolerance = Decimal(tolerance).scaleb(places)  # exactly as compared in match_greedy()
+    # |a + b| < tolerance <=> |a + b| <= distance, for integers a and b
+    distance = int(scaled_tolerance.to_integral_value(rounding=ROUND_FLOOR))
+    if distance == scaled_tolerance:
+        distance -= 1
+    return scaled, distance
+
+
+def _import_numpy():
+    """Return the numpy module, or None if it is not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def match_greedy_numpy(dates, numbers, date_range, tolerance, start=0, settled=(), scanned=None, budget=None):
+    """Same as match_greedy(), but vectorized with NumPy, which avoids Decimal arithmetic in the
+    matching loop.
+
+    Amounts are scaled to integers (eg: cents), so that the tolerance becomes an integer
+    distance. Postings are sorted by (amount, date), and a searchsorted() over the sorted amounts
+    gives, for every posting at once, the range of postings with a complementary amount.
+    Another one over the dates gives the end of its date range. Picking matches is inherently
+    sequential (each match removes candidates for later postings), and is done on plain ints,
+    skipping matched postings as in AmountIndex.
+
+    Falls back to match_greedy() if NumPy is not installed, or amounts don't fit in 64 bits.
+    Here, scanned counts (and budget is charged for) the runs of equal amounts looked at for
+    each posting.
+    """
+    np = _import_numpy()
+    scaled = _scale_to_integers(numbers, tolerance) if np is not None and tolerance > 0 else None
+    if scaled is None:
+        return match_greedy(dates, numbers, date_range, tolerance, start, settled, scanned, budget)
+    n = len(numbers)
+    amounts = np.array(scaled[0], dtype=np.int64)
+    ordinals = np.array([date.toordinal() for date in dates], dtype=np.int32)
+
+    order = np.lexsort((np.arange(n), amounts))
+    sorted_amounts = amounts[order]
+    lo = np.searchsorted(sorted_amounts, -amounts - scaled[1], side='left').tolist()
+    hi = np.searchsorted(sorted_amounts, -amounts + scaled[1], side='right').tolist()
+    limit = np.searchsorted(ordinals, ordinals + date_range, side='right').tolist()
+    # runs of equal amounts within the sorted order, each of which is sorted by seq
+    run_starts = np.flatnonzero(np.diff(sorted_amounts, prepend=sorted_amounts[:1] - 1)).tolist()
+    run_of = np.repeat(np.arange(len(run_starts)), np.diff(run_starts + [n])).tolist() + [len(run_starts)]
+    run_starts.append(n)
+    position = np.argsort(order).tolist()
+    sorted_seqs = order.tolist()
+
+    skip = list(range(n + 1))
+    matched = bytearray(n)
+    pairs = [tuple(pair) for pair in settled]
+    for seq in (seq for pair in pairs for seq in pair):
+        matched[seq] = 1
+        skip[position[seq]] = position[seq] + 1
+
+    for seq in range(start, n):
+        if matched[seq]:
+            continue
+        if budget is not None and budget.exceeded(dates[seq]):
+            break
+        best = limit[seq]
+        runs = range(run_of[lo[seq]], run_of[hi[seq]])
+        for run in runs:
+            pos = AmountIndex._next(skip, bisect.bisect_right(sorted_seqs, seq, run_starts[run], run_starts[run + 1]))
+            if pos < run_starts[run + 1] and sorted_seqs[pos] < best:
+                best = sorted_seqs[pos]
+        if scanned is not None:
+            scanned[len(runs)] += 1
+        if budget is not None:
+            budget.comparisons += len(runs)
+        if best < limit[seq]:
+            for s in (seq, best):
+                matched[s] = 1
+                skip[position[s]] = position[s] + 1
+            pairs.append((seq, best))
+    return pairs
+
+
+def _independent_components(dates, numbers, date_range, tolerance):
+    """Split postings into groups that can only ever match within the group: postings are first
+    grouped into classes of (absolute) amounts within tolerance of each other, and each class is
+    then split wherever consecutive postings are more than date_range days apart."""
+    window = datetime.timedelta(days=date_range)
+    classes = []
+    for seq in sorted(range(len(numbers)), key=lambda seq: abs(numbers[seq])):
+        if classes and abs(numbers[seq]) - abs(numbers[classes[-1][-1]]) < tolerance:
+            classes[-1].append(seq)
+        else:
+            classes.append([seq])
+
+    for members in classes:
+        members.sort()
+        component = [members[0]]
+        for a, b in zip(members, members[1:]):
+            if dates[b] - dates[a] > window:
+                yield component
+                component = []
+            component.append(b)
+        yield component
+
+
+def _pair_closest_first(members, dates, numbers, window, tolerance):
+    """Repeatedly pair the two closest-in-date postings in members (a date-sorted list) that
+    match. Postings are kept in a linked list, and a heap holds the date gap of each pair of
+    neighbouring postings that would match. Popping the smallest gap and splicing that pair out
+    of the list makes their outer neighbours adjacent, so overlapping transfers are paired up
+    nested, closest first."""
+    prev = dict(zip(members[1:], members))
+    succ = dict(zip(members, members[1:]))
+    heap = []
+
+    def push(a, b):
+        if (a is not None and b is not None and dates[b] - dates[a] <= window
+           and abs(numbers[a] + numbers[b]) < tolerance):
+            heapq.heappush(heap, (dates[b] - dates[a], a, b))
+
+    for a, b in succ.items():
+        push(a, b)
+
+    pairs = []
+    matched = set()
+    while heap:
+        _, a, b = heapq.heappop(heap)
+        if a in matched or b in matched:
+            continue
+        matched.update((a, b))
+        pairs.append((a, b))
+        before, after = prev.get(a), succ.get(b)
+        if before is not None:
+            succ[before] = after
+        if after is not None:
+            prev[after] = before
+        push(before, after)
+    return pairs
+
+
+def match_closest(dates, numbers, date_range, tolerance, budget=None):
+    """Pair postings with their closest-in-date match, closest pairs first.
+
+    Greedy matching may pair a posting with an earlier transfer of the same amount, when a
+    later one was a much closer fit. Here, each independent group of postings is instead
+    swept closest pair first (see _pair_closest_first()). This is a heuristic, not a minimum
+    total date gap: closest first can strand postings that greedy would have matched, or pair
+    the outer postings of a group across a larger gap than greedy would. So, for each group,
+    the greedy pairs are kept instead when they match more postings, or as many postings over
+    a smaller total date gap. Runs in O(n log n). Arguments and return value are the
+    same as for match_greedy(). budget is only charged by the greedy pass: if that stops early,
+    groups reaching past where it stopped keep whatever greedy pairs it found.
+    """
+    window = datetime.timedelta(days=date_range)
+    greedy_partner = {}
+    for a, b in match_greedy(dates, numbers, date_range, tolerance, budget=budget):
+        greedy_partner[a] = b
+        greedy_partner[b] = a
+    stopped_at = budget.stopped_at if budget is not None else None
+
+    pairs = []
+    for members in _independent_components(dates, numbers, date_range, tolerance):
+        greedy = [(a, greedy_partner[a]) for a in members if greedy_partner.get(a, -1) > a]
+        if stopped_at is not None and dates[members[-1]] >= stopped_at:
+            pairs.extend(greedy)  # not all of the group was examined
+            continue
+        closest = _pair_closest_first(members, dates, numbers, window, tolerance)
+        pairs.extend(min(closest, greedy, key=lambda group_pairs: (
+            -len(group_pairs), sum((dates[b] - dates[a]).days for a, b in group_pairs))))
+    pairs.sort()
+    return pairs
+
+
+def _find_pair(values, start, target, tolerance, budget=None):
+    """Find two entries in values[start:] (sorted ascending) that sum up to target, within
+    tolerance, with two pointers moving inwards. Returns a list of their indexes, or None.
+    Each pointer step is charged to budget, if given."""
+    lo, hi = start, len(values) - 1
+    found = None
+    while lo < hi:
+        total = values[lo] + values[hi]
+        if total <= target - tolerance:
+            lo += 1
+        elif total >= target + tolerance:
+            hi -= 1
         else:
-            posting.meta = {matching_id_string: match_id}
+            found = [lo, hi]
+            break
+    if budget is not None:
+        budget.comparisons += len(values) - start - (hi - lo)
+    return found
 
 
-def transaction_update(txn, match_id, link_prefix):
-    if match_id and link_prefix:
-        txn.links.add(link_prefix + match_id)
+def _find_subset(values, target, size, tolerance, budget=None):
+    """Find size (2 or more) entries in values (sorted ascending) that sum up to target, within
+    tolerance.
 
+    Bigger subsets are reduced to a search for a pair by fixing their smallest entry. Prefix
+    sums let us prune any smallest entry for which even the smallest (or largest) possible
+    completion overshoots (or undershoots) the target.
 
-def zerosum(entries, options_map, config):  # noqa: C901
+    Each entry tried and each pair search step is charged to budget, if given, and the search
+    gives up (returning None) as soon as it is used up.
+
+    Returns:
+      A list of indexes into values, or None.
+    """
+    prefix = [0]
+    for value in values:
+        prefix.append(prefix[-1] + value)
+
+    def search(start, size, target):
+        if size == 2:
+            return _find_pair(values, start, target, tolerance, budget)
+        for i in range(start, len(values) - size + 1):
+            if budget is not None:
+                if budget.used_up():
+                    return None
+                budget.comparisons += 1
+            if prefix[i + size] - prefix[i] >= target + tolerance:
+                break  # the smallest sum starting at i is too big, and only grows with i
+            if values[i] + prefix[-1] - prefix[-size] <= target - tolerance:
+                continue  # the largest sum starting at i is too small
+            found = search(i + 1, size - 1, target - values[i])
+            if found:
+                return [i] + found
+        return None
+
+    return search(0, size, target)
+
+
+def match_subsets(dates, numbers, currencies, date_range, tolerance, max_subset_size, matched, budget=None):
+    """Match single postings against sets of several postings that together sum up to zero with
+    it, such as a transfer that was settled by two or more deposits.
+
+    Only postings not already matched are considered, so this is intended to be run on what is
+    left over after pairwise matching. For each such posting, in date order, candidates are the
+    next MAX_SUBSET_CANDIDATES leftover postings of the same currency at most date_range days
+    later: every set that sums up to zero is found from its earliest posting, and, as with
+    pairwise matching, a match never spans more than date_range days. Smaller subsets are
+    preferred. The search for each posting is exhaustive over its candidates, so it costs up to
+    MAX_SUBSET_CANDIDATES ** (max_subset_size - 1) steps.
+
+    Args:
+      dates, numbers, date_range, tolerance: see match_greedy()
+      currencies: list of posting currencies, in the same order as dates
+      max_subset_size: maximum number of postings that may sum up to zero with a single one
+      matched: set of seqs that are already matched. Updated with newly matched seqs.
+      budget: optional MatchBudget, charged for the candidates of each posting and for each step
+        of the search (see _find_subset()). A search that runs out of budget leaves its posting,
+        and the later ones, unmatched
+    Returns:
+      A list of tuples of matched seqs. The earliest posting, whose candidates were searched,
+      comes first in each tuple.
+    """
+    window = datetime.timedelta(days=date_range)
+    tolerance = Decimal(str(tolerance))
+    matches = []
+    for seq in range(len(numbers)):
+        if seq in matched:
+            continue
+        if budget is not None and budget.exceeded(dates[seq]):
+            break
+        hi = bisect.bisect_right(dates, dates[seq] + window)
+        candidates = []
+        for c in range(seq + 1, hi):
+            if c not in matched and currencies[c] == currencies[seq]:
+                candidates.append(c)
+                if len(candidates) == MAX_SUBSET_CANDIDATES:
+                    break
+        candidates.sort(key=lambda c: numbers[c])
+        values = [numbers[c] for c in candidates]
+        if budget is not None:
+            budget.comparisons += len(candidates)
+        for size in range(2, min(max_subset_size, len(candidates)) + 1):
+            found = _find_subset(values, -numbers[seq], size, tolerance, budget)
+            if found:
+                match = (seq,) + tuple(sorted(candidates[i] for i in found))
+                matched.update(match)
+                matches.append(match)
+                break
+            if budget is not None and budget.exceeded(dates[seq]):
+                return matches  # seq was not fully searched
+    return matches
+
+
+MATCH_MODES = {
+    'greedy': match_greedy,
+    'closest': match_closest,
+}
+
+
+def match_account(postings, date_range, tolerance, match_mode='greedy', max_subset_size=1, resume=(0, ()),
+                  engine='python', currency_tolerance=None, stats=None, budget=None):
+    """Find the matches among the postings of a single zerosum account.
+
+    Postings only ever match postings of the same currency, so they are partitioned by
+    currency, and each partition is matched separately.
+
+    This deals only in plain values rather than beancount entries, so that it is cheap to
+    ship to (and back from) a worker process.
+
+    Args:
+      postings: list of (date, number, currency) tuples, sorted by date
+      date_range, tolerance: see match_greedy()
+      match_mode: key in MATCH_MODES
+      max_subset_size: see match_subsets()
+      resume: (start, settled) to resume greedy matching with. See match_greedy() and
+        reusable_matches()
+      engine: 'numpy' to use match_greedy_numpy() for greedy matching
+      currency_tolerance: dict of currency -> tolerance, overriding tolerance for that currency
+      stats: optional dict, filled in with statistics about the matching. See account_stats()
+      budget: optional MatchBudget for the whole account. Postings are left unmatched once it
+        is used up
+    Returns:
+      A list of tuples of matched postings, as indexes into postings, ordered by their first
+      posting.
+    """
+    start_time = time.time()
+    if budget is not None:
+        budget.start()
+    scanned = collections.Counter() if stats is not None else None
+    partitions = defaultdict(list)
+    for seq, posting in enumerate(postings):
+        partitions[posting[2]].append(seq)
+    start, settled = resume
+
+    matches = []
+    for currency, seqs in partitions.items():
+        local = {seq: i for i, seq in enumerate(seqs)}
+        local_resume = (bisect.bisect_left(seqs, start),
+                        [tuple(local[seq] for seq in match) for match in settled if match[0] in local])
+        local_matches = _match_partition([postings[seq] for seq in seqs], date_range,
+                                         (currency_tolerance or {}).get(currency, tolerance),
+                                         match_mode, max_subset_size, local_resume, engine, scanned, budget)
+        matches.extend(tuple(seqs[i] for i in match) for match in local_matches)
+    matches.sort(key=lambda match: match[0])
+    if stats is not None:
+        stats.update(account_stats(postings, date_range, matches, scanned))
+        stats['cached_postings'] = start
+        stats['match_seconds'] = time.time() - start_time
+    return matches
+
+
+def _match_partition(postings, date_range, tolerance, match_mode, max_subset_size, resume, engine, scanned, budget):
+    """match_account() for postings that are all of the same currency."""
+    dates = [p[0] for p in postings]
+    numbers = [p[1] for p in postings]
+    if match_mode == 'greedy':
+        greedy = match_greedy_numpy if engine == 'numpy' else match_greedy
+        matches = greedy(dates, numbers, date_range, tolerance, *resume, scanned=scanned, budget=budget)
+    elif resume[0]:
+        matches = match_greedy(dates, numbers, date_range, tolerance, *resume, budget=budget)
+    else:
+        matches = MATCH_MODES[match_mode](dates, numbers, date_range, tolerance, budget=budget)
+    if max_subset_size > 1:
+        matched = set(seq for match in matches for seq in match)
+        matches += match_subsets(dates, numbers, [p[2] for p in postings],
+                                 date_range, tolerance, max_subset_size, matched, budget)
+    return matches
+
+
+def match_accounts(jobs, tolerance, match_mode, max_subset_size, workers=0, engine='python', currency_tolerance=None,
+                   stats=None, budgets=None, shard_days=None):
+    """Run match_account() for each zerosum account, in a pool of worker processes if workers is
+    more than 1. Accounts are matched independently of each other, so this is safe to do.
+    With shard_days, large accounts are further split into shards matched in parallel. See
+    merge_shards().
+
+    Args:
+      jobs: dict of zerosum account -> (postings, date_range, resume, account_tolerance). See
+        match_account(). account_tolerance, if not None, replaces tolerance for the account
+      workers: number of worker processes. 0 or 1 matches in this process
+      engine, currency_tolerance: see match_account()
+      stats: optional dict, filled in with zerosum account -> statistics. See account_stats()
+      budgets: optional dict of zerosum account -> MatchBudget for the account. The budgets are
+        updated with how far matching got
+      shard_days: optional number of days per shard, when workers is more than 1. Only greedy
+        pairwise matching without a budget or cached matches to resume from is sharded
+    Returns:
+      A dict of zerosum account -> list of matches. See match_account()
+    """
+    budgets = budgets if budgets is not None else {}
+    job_args = {account: (postings, date_range, tolerance if account_tolerance is None else account_tolerance,
+                          match_mode, max_subset_size, resume, engine, currency_tolerance, budgets.get(account),
+                          stats is not None)
+                for account, (postings, date_range, resume, account_tolerance) in jobs.items()}
+    shards = _shard_job_args(job_args, shard_days) if shard_days and workers > 1 else {}
+    results = None
+    if workers > 1 and len(job_args) > 1:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(job_args))) as executor:
+                futures = {account: executor.submit(_match_account_job, *args) for account, args in job_args.items()}
+                results = {account: future.result() for account, future in futures.items()}
+        except (OSError, NotImplementedError, concurrent.futures.process.BrokenProcessPool):
+            pass  # no usable multiprocessing on this system: match in this process instead
+    if results is None:
+        results = {account: _match_account_job(*args) for account, args in job_args.items()}
+    for account, bounds in shards.items():
+        postings, date_range, account_tolerance = jobs[account][0], jobs[account][1], job_args[account, 0][2]
+        shard_results = [results.pop((account, k)) for k in range(len(bounds))]
+        matches = merge_shards(postings, date_range, account_tolerance, currency_tolerance, bounds,
+                               [shard_matches for shard_matches, _, _ in shard_results])
+        account_stats = None
+        if stats is not None:
+            account_stats = _merge_shard_stats(postings, date_range, matches, [stats for _, stats, _ in shard_results])
+        results[account] = (matches, account_stats, None)
+    if stats is not None:
+        stats.update((account, account_stats) for account, (_, account_stats, _) in results.items())
+    budgets.update((account, budget) for account, (_, _, budget) in results.items() if budget is not None)
+    return {account: matches for account, (matches, _, _) in results.items()}
+
+
+def _match_account_job(*args):
+    """Run match_account() and return (matches, stats, budget). The last two of args are the
+    budget and whether to collect stats. The stats and budget are returned rather than updated in
+    place, so that this works in a worker process."""
+    stats = {} if args[-1] else None
+    budget = args[-2]
+    return match_account(*args[:-2], stats=stats, budget=budget), stats, budget
+
+
+def shard_bounds(postings, date_range, shard_days):
+    """Split date-sorted postings into shards of shard_days days (at least date_range). Returns
+    a list of (start, end, lookahead) for each shard: the shard is postings[start:end], and
+    postings[end:lookahead] are the postings after it that its postings can match."""
+    dates = [posting[0] for posting in postings]
+    span = datetime.timedelta(days=max(shard_days, date_range))
+    window = datetime.timedelta(days=date_range)
+    bounds = []
+    start = 0
+    while start < len(dates):
+        end = bisect.bisect_left(dates, dates[start] + span, start)
+        bounds.append((start, end, bisect.bisect_right(dates, dates[end - 1] + window, end)))
+        start = end
+    return bounds
+
+
+def _shard_job_args(job_args, shard_days):
+    """Replace the job of each account in job_args (see match_accounts()) that can be sharded, and
+    has more than one shard, with a job per shard, keyed by (account, shard number). Returns a dict
+    of account -> shard_bounds()."""
+    shards = {}
+    for account, args in list(job_args.items()):
+        postings, date_range, _, match_mode, max_subset_size, resume, _, _, budget, _ = args
+        if match_mode != 'greedy' or max_subset_size > 1 or resume[0] or budget is not None:
+            continue
+        bounds = shard_bounds(postings, date_range, shard_days)
+        if len(bounds) < 2:
+            continue
+        shards[account] = bounds
+        del job_args[account]
+        for k, (start, _, lookahead) in enumerate(bounds):
+            job_args[account, k] = (postings[start:lookahead],) + args[1:]
+    return shards
+
+
+def _merge_shard_stats(postings, date_range, matches, shard_stats):
+    """Return the account_stats() of a sharded account, from the stats of its shards."""
+    scanned = collections.Counter()
+    for stats in shard_stats:
+        scanned.update(stats['scanned'])
+    return dict(account_stats(postings, date_range, matches, scanned), cached_postings=0, shards=len(shard_stats),
+                match_seconds=sum(stats['match_seconds'] for stats in shard_stats))
+
+
+def merge_shards(postings, date_range, tolerance, currency_tolerance, bounds, shard_matches):
+    """Combine the greedy matches found in each shard of an account's postings into the matches
+    of a single greedy run over all of them.
+
+    Each shard (see shard_bounds()) is matched on its own, along with the postings after it
+    that its postings can match. Since a shard is at least date_range days long, only the shard
+    right before it can match (and use up) any of its postings. Its matches are right as they
+    are unless that shard did, in which case reconcile_shard() fixes them up.
+
+    Args:
+      postings, date_range, tolerance, currency_tolerance: see match_account()
+      bounds: shard_bounds() of postings
+      shard_matches: for each shard, the matches of match_account() on its postings, including
+        those after it
+    Returns:
+      A list of pairs of matched postings, as for match_account().
+    """
+    partitions = defaultdict(list)
+    for seq, posting in enumerate(postings):
+        partitions[posting[2]].append(seq)
+
+    window = datetime.timedelta(days=date_range)
+    matches = []
+    for currency, seqs in partitions.items():
+        local = {seq: i for i, seq in enumerate(seqs)}
+        shards = []
+        for (start, end, _), found in zip(bounds, shard_matches):
+            pairs = [(local[start + a], local[start + b]) for a, b in found
+                     if start + a < end and postings[start + a][2] == currency]
+            shards.append((bisect.bisect_left(seqs, start), bisect.bisect_left(seqs, end), pairs))
+        dates = [postings[seq][0] for seq in seqs]
+        numbers = [postings[seq][1] for seq in seqs]
+        partition_tolerance = (currency_tolerance or {}).get(currency, tolerance)
+        taken = set()  # postings of the next shard used up by the matches of the previous one
+        for start, end, pairs in shards:
+            if taken:
+                pairs = reconcile_shard(dates, numbers, window, partition_tolerance, start, end, pairs, taken)
+            matches.extend((seqs[a], seqs[b]) for a, b in pairs)
+            taken = {b for _, b in pairs if b >= end}
+    matches.sort()
+    return matches
+
+
+def reconcile_shard(dates, numbers, window, tolerance, start, end, pairs, taken):
+    """Redo the greedy matching of the shard of postings [start, end), given that the postings in
+    taken were already used up by the shard before it. pairs are its matches when none are.
+
+    Greedy matching only ever pairs a posting with a later one, so its state at any posting is
+    the set of later postings used up so far. Matching is redone from the start of the shard
+    while keeping track of how that set differs from the one behind pairs. As soon as they are
+    the same, all further matches are too, and the rest of pairs is kept. In practice, this
+    only takes the first few days of the shard.
+    """
+    partners = dict(pairs)
+    used = set(partners.values())
+    span = window * 4 + datetime.timedelta(days=1)
+    while True:
+        limit = bisect.bisect_right(dates, dates[start] + span)
+        index = AmountIndex(dates[start:limit], numbers[start:limit], tolerance)
+        for seq in taken:
+            index.remove(seq - start)
+        differ = set(taken)
+        redone = []
+        for seq in range(start, end):
+            if limit < len(dates) and dates[limit] <= dates[seq] + window:
+                break  # postings past limit are within seq's date range: redo with more of them
+            partner = None
+            if not index.matched[seq - start]:
+                found = index.find(seq - start, dates[seq] + window)
+                if found is not None:
+                    index.remove(seq - start)
+                    index.remove(found)
+                    partner = found + start
+                    redone.append((seq, partner))
+            for used_up in (partner, None if seq in used else partners.get(seq)):
+                if used_up is not None:
+                    differ ^= {used_up}  # used up by only one of the two, or by both: no difference
+            differ.discard(seq)
+            if not differ:
+                return redone + [pair for pair in pairs if pair[0] > seq]
+        else:
+            return redone
+        span *= 2
+
+
+def _histogram(counts):
+    """Return a Counter as a dict of value -> number of occurrences, sorted by value."""
+    return dict(sorted(counts.items()))
+
+
+def account_stats(postings, date_range, matches, scanned):
+    """Return statistics about the matching of a zerosum account, to help size its date_range
+    and catch regressions:
+
+    - 'candidates', 'currencies': number of postings in the account, and of their currencies
+    - 'matches', 'matched_postings': number of matches found, and of postings in them
+    - 'date_range': the account's date_range
+    - 'match_gap_days': histogram of the number of days between the first and last posting of
+      each match
+    - 'window_sizes': histogram of the number of postings of the same currency within
+      date_range days after each posting (i.e.: the candidates for matching it)
+    - 'scanned': histogram of the number of postings compared per lookup (greedy mode only)
+
+    Histograms are dicts of value -> number of occurrences.
+    """
+    partitions = defaultdict(list)
+    for posting in postings:
+        partitions[posting[2]].append(posting[0])
+    window = datetime.timedelta(days=date_range)
+    window_sizes = []
+    for dates in partitions.values():
+        window_sizes.extend(bisect.bisect_right(dates, date + window) - i - 1 for i, date in enumerate(dates))
+    return {
+        'candidates': len(postings),
+        'currencies': len(partitions),
+        'matches': len(matches),
+        'matched_postings': sum(len(match) for match in matches),
+        'date_range': date_range,
+        'match_gap_days': _histogram(collections.Counter(
+            (postings[max(match)][0] - postings[min(match)][0]).days for match in matches)),
+        'window_sizes': _histogram(collections.Counter(window_sizes)),
+        'scanned': _histogram(scanned),
+    }
+
+
+def learned_date_range(dates, matches, percentile):
+    """Return the smallest date range, in days, that percentile % of an account's matches fit
+    in, or None if it has none. dates are the dates of the account's postings."""
+    gaps = sorted((dates[max(match)] - dates[min(match)]).days for match in matches)
+    if not gaps:
+        return None
+    return gaps[max(0, math.ceil(len(gaps) * percentile / 100) - 1)]
+
+
+def tune_date_ranges(all_candidates, all_matches, entries, options, groups, learned_date_ranges, stats, auto_window):
+    """Learn the date range of each zerosum account (or match group) that has not learned one
+    yet from its matches into learned_date_ranges. With auto_window 'apply', that's only done
+    once, from matches found with the configured date range, and kept in the match cache;
+    with 'report', learned_date_ranges is empty, so that the date range is learned from the
+    current matches on every run. Returns errors reporting the accounts whose date range could
+    be smaller. Learned date ranges are added to stats, if given."""
+    errors = []
+    percentile = options['auto_window_percentile']
+    for zs_account, candidates in all_candidates.items():
+        date_range = (groups.get(zs_account) or options['zerosum_accounts'][zs_account]).date_range
+        learned = learned_date_ranges.get(zs_account)
+        if learned is None:
+            learned = learned_date_ranges[zs_account] = learned_date_range(
+                [entries[i].date for i, _ in candidates], all_matches[zs_account], percentile)
+        if stats is not None:
+            stats[zs_account]['learned_date_range'] = learned
+        if learned is not None and learned < date_range and auto_window == 'report':
+            errors.append(ZerosumError(
+                data.new_metadata('<zerosum>', 0),
+                "Zerosum account {}: {}% of its matches are within {} days, but its date range is {} days".format(
+                    zs_account, percentile, learned, date_range), None))
+    return errors
+
+
+def posting_fingerprint(txn, posting):
+    """Return a short, stable identifier of a posting, for the match cache."""
+    meta = posting.meta or {}
+    key = (meta.get('filename'), meta.get('lineno'), txn.date.isoformat(),
+           str(posting.units.number), posting.units.currency, posting.account)
+    return hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+
+def cache_key(options):
+    """Return the part of the config that match results depend on. Cached matches are thrown
+    away whenever this changes."""
+    return repr((CACHE_VERSION, sorted(options['zerosum_accounts'].config.items()), options['account_name_replace'],
+                 [(account, target, date_range, str(tolerance))
+                  for account, target, date_range, tolerance in options['open_accounts']],
+                 str(options['tolerance']),
+                 sorted((currency, str(tolerance)) for currency, tolerance in options['currency_tolerance'].items()),
+                 options['match_mode'], options['max_subset_size'], [tuple(group) for group in options['match_groups']],
+                 str(options['auto_window_percentile'])))
+
+
+def load_match_cache(path, key):
+    """Load the cached matches of each zerosum account, or return {} if there are none that were
+    found with the same config."""
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('config') != key:
+        return {}
+    return cache.get('accounts', {})
+
+
+def save_match_cache(path, key, accounts):
+    """Save the matches of each zerosum account. accounts maps zerosum account -> {'postings':
+    list of posting fingerprints, 'matches': list of matches, 'date_range': the date range they
+    were found with, 'learned_date_range': see learned_date_range()}."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        cache_file.write(json.dumps({'config': key, 'accounts': accounts}))
+    os.replace(tmp_path, path)
+
+
+def reusable_matches(cached, fingerprints, dates, date_range, match_mode, max_subset_size):
+    """Work out what part of an account's cached matches is still valid.
+
+    If the account's postings are unchanged, all of its cached matches are. Otherwise, with
+    greedy pairwise matching, a posting is matched only against the postings in its date range,
+    so the cached match (or lack thereof) of every posting whose date range ends before the
+    first changed posting still holds. Typically, only the last few days have to be matched
+    again. Other modes get no partial reuse.
+
+    Args:
+      cached: the account's entry in the match cache, or None
+      fingerprints: list of posting_fingerprint() of the account's postings, in date order
+      dates: list of the dates of these postings
+    Returns:
+      (start, settled): settled are the matches that still hold, and start is the first posting
+      that needs matching. start is len(fingerprints) if nothing does.
+    """
+    old = cached.get('postings') if cached else None
+    if old is None:
+        return 0, []
+    if old == fingerprints:
+        return len(fingerprints), [tuple(match) for match in cached['matches']]
+    if match_mode != 'greedy' or max_subset_size > 1:
+        return 0, []
+
+    changed = 0
+    while changed < min(len(old), len(fingerprints)) and old[changed] == fingerprints[changed]:
+        changed += 1
+    if changed == 0:
+        return 0, []
+    # anything from dates[changed - 1] on might have been added, removed or changed
+    start = bisect.bisect_left(dates, dates[changed - 1] - datetime.timedelta(days=date_range))
+    return start, [tuple(match) for match in cached['matches'] if match[0] < start]
+
+
+def match_edges(match, match_id, candidates, entries):
+    """Return the MatchEdges of a match: from its first posting to each of the others. gap is
+    the number of days between the two postings."""
+    refs = []
+    for seq in match:
+        i, j = candidates[seq]
+        txn = entries[i]
+        units = txn.postings[j].units
+        refs.append(PostingRef(txn.meta.get('filename'), txn.meta.get('lineno'), j, txn.date,
+                               txn.postings[j].account, units.number, units.currency))
+    return [MatchEdge(match_id, refs[0], ref, abs((ref.date - refs[0].date).days)) for ref in refs[1:]]
+
+
+def export_match_graph(path, graph):
+    """Write a match graph to an SQLite database at path, replacing its contents. The
+    matched_postings table has a row for each matched posting, with the id and gap (in days,
+    between its earliest and latest posting) of its match, and is indexed by date, account,
+    currency and amount, match id and location, so that "what matched this?" is two indexed
+    lookups. Amounts are exact: they are stored as text, without trailing zeros (eg: '-10',
+    '0.000123456789'), which SQLite also compares numbers given in queries against."""
+    postings = {}
+    for edge in graph:
+        for ref in (edge.first, edge.second):
+            postings[(edge.match_id, ref.filename, ref.lineno, ref.index)] = ref
+    gaps = defaultdict(int)
+    for edge in graph:
+        gaps[edge.match_id] = max(gaps[edge.match_id], edge.gap)
+
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS matched_postings')
+            connection.execute('CREATE TABLE matched_postings (match_id TEXT, account TEXT, date TEXT, number TEXT, '
+                               'currency TEXT, filename TEXT, lineno INTEGER, posting_index INTEGER, gap INTEGER)')
+            connection.executemany(
+                'INSERT INTO matched_postings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((match_id, ref.account, ref.date.isoformat(), format(ref.number.normalize(), 'f'), ref.currency,
+                  ref.filename,
+                  ref.lineno, ref.index, gaps[match_id]) for (match_id, *_), ref in postings.items()))
+            for columns in ('date', 'account', 'currency, number', 'match_id', 'filename, lineno'):
+                connection.execute('CREATE INDEX matched_postings_{} ON matched_postings ({})'.format(
+                    columns.replace(', ', '_'), columns))
+    finally:
+        connection.close()
+
+
+def save_stats(path, stats):
+    """Write the stats filled in by zerosum() to path, as JSON."""
+    with open(path, 'w') as stats_file:
+        json.dump(stats, stats_file, indent=2)
+
+
+def generate_match_id(postings):
+    '''Generates the match ID of the matched postings, given as (transaction, posting index)
+    pairs: a hash of their location, date and amount, so that a match gets the same ID on every
+    run, whatever order the plugins run in.'''
+    key = sorted(((txn.meta or {}).get('filename'), (txn.meta or {}).get('lineno'), index, txn.date.isoformat(),
+                  str(txn.postings[index].units)) for txn, index in postings)
+    return hashlib.blake2b(repr(key).encode(), digest_size=10).hexdigest()
+
+
+def check_options(options):
+    """Return (match_mode, engine, auto_window, errors): the options of those names, with unknown
+    values replaced by their defaults and reported as errors."""
+    errors = []
+    match_mode, engine, auto_window = options['match_mode'], options['engine'], options['auto_window']
+    if match_mode not in MATCH_MODES:
+        errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                   "Unknown zerosum match_mode '{}', using 'greedy'".format(match_mode), None))
+        match_mode = 'greedy'
+    if engine not in ('python', 'numpy'):
+        errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                   "Unknown zerosum engine '{}', using 'python'".format(engine), None))
+        engine = 'python'
+    if auto_window not in (None, 'report', 'apply'):
+        errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                   "Unknown zerosum auto_window '{}', ignoring it".format(auto_window), None))
+        auto_window = None
+    elif auto_window == 'apply' and not options['cache_file']:
+        errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                   "Zerosum auto_window 'apply' needs a cache_file, reporting instead", None))
+        auto_window = 'report'
+    return match_mode, engine, auto_window, errors
+
+
+def collect_postings(entries, zs_accounts_list, group_of):
+    """Return zerosum account -> list of (entry index, posting index) of its postings.
+
+    The postings of all zerosum accounts are collected in a single pass: each posting's account
+    is looked up in zs_accounts_list, so the cost does not grow with the number of zerosum
+    accounts (or patterns). The postings of the accounts in a match group are collected
+    together, under the group's name."""
+    all_candidates = defaultdict(list, ((group_of.get(zs_account, zs_account), [])
+                                        for zs_account in zs_accounts_list.named))
+    for i, entry in enumerate(entries):
+        if isinstance(entry, data.Transaction):
+            for j, posting in enumerate(entry.postings):
+                if zs_accounts_list[posting.account] is not None:
+                    all_candidates[group_of.get(posting.account, posting.account)].append((i, j))
+    return all_candidates
+
+
+def plan_matching(entries, all_candidates, options, groups, match_mode, auto_window, match_cache, all_stats):
+    """Return (jobs, all_matches, new_match_cache, learned_date_ranges) for matching the postings
+    of all_candidates (see collect_postings()):
+
+    - jobs: zerosum account -> arguments of match_accounts(), for the accounts to match
+    - all_matches: zerosum account -> matches, for the accounts whose matches all come from
+      match_cache
+    - new_match_cache: the match cache to save once the jobs are matched, without their matches
+      yet, or None if match_cache is None (there is no cache_file)
+    - learned_date_ranges: zerosum account -> date range learned by an earlier run, for 'apply'
+
+    The statistics of the accounts whose matches all come from match_cache are added to
+    all_stats, if given."""
+    zs_accounts_list = options['zerosum_accounts']
+    jobs = {}
+    all_matches = {}
+    new_match_cache = {} if match_cache is not None else None
+    learned_date_ranges = {}
+    for zs_account, account_candidates in all_candidates.items():
+        account_config = groups.get(zs_account) or zs_accounts_list[zs_account]
+        date_range = account_config.date_range
+        candidates = [(entries[i], entries[i].postings[j]) for i, j in account_candidates]
+        resume = (0, [])
+        if match_cache is not None:
+            cached = match_cache.get(zs_account)
+            learned_date_ranges[zs_account] = (cached.get('learned_date_range')
+                                               if cached and auto_window == 'apply' else None)
+            if auto_window == 'apply' and learned_date_ranges[zs_account] is not None:
+                date_range = learned_date_ranges[zs_account]
+            if cached and cached.get('date_range') != date_range:
+                cached = None
+            fingerprints = [posting_fingerprint(txn, posting) for txn, posting in candidates]
+            new_match_cache[zs_account] = {'postings': fingerprints, 'date_range': date_range,
+                                           'learned_date_range': learned_date_ranges[zs_account]}
+            resume = reusable_matches(cached, fingerprints, [txn.date for txn, _ in candidates],
+                                      date_range, match_mode, options['max_subset_size'])
+            if resume[0] == len(candidates):
+                all_matches[zs_account] = resume[1]
+                if all_stats is not None:
+                    all_stats[zs_account] = dict(
+                        account_stats([(txn.date, None, posting.units.currency) for txn, posting in candidates],
+                                      date_range, resume[1], collections.Counter()),
+                        cached_postings=len(candidates), match_seconds=0.0)
+                continue
+        jobs[zs_account] = ([(txn.date, posting.units.number, posting.units.currency) for txn, posting in candidates],
+                            date_range, resume, account_config.tolerance)
+    return jobs, all_matches, new_match_cache, learned_date_ranges
+
+
+def make_budgets(options, zs_accounts):
+    """Return zerosum account -> MatchBudget for zs_accounts, or None if options set no budget."""
+    if options['max_comparisons'] is None and options['max_milliseconds'] is None:
+        return None
+    return {zs_account: MatchBudget(options['max_comparisons'], options['max_milliseconds'])
+            for zs_account in zs_accounts}
+
+
+def budget_errors(budgets, new_match_cache):
+    """Return errors for the zerosum accounts whose budget ran out, dropping them from
+    new_match_cache (if not None), so that their partial matches aren't cached."""
+    errors = []
+    for zs_account, budget in (budgets or {}).items():
+        if budget.stopped_at is not None:
+            errors.append(ZerosumError(
+                data.new_metadata('<zerosum>', 0),
+                "Zerosum account {}: matching ran out of budget after {} comparisons; its postings from {} on "
+                "were not looked at, and may be left unmatched".format(
+                    zs_account, budget.comparisons, budget.stopped_at), None))
+            if new_match_cache is not None:
+                new_match_cache.pop(zs_account, None)
+    return errors
+
+
+def update_match_cache(path, key, new_match_cache, all_matches, learned_date_ranges):
+    """Add the matches and learned date ranges to new_match_cache (see plan_matching()), and save
+    it to path. Returns errors."""
+    for zs_account in new_match_cache:
+        new_match_cache[zs_account]['matches'] = all_matches[zs_account]
+        new_match_cache[zs_account]['learned_date_range'] = learned_date_ranges[zs_account]
+    try:
+        save_match_cache(path, key, new_match_cache)
+    except OSError as err:
+        return [ZerosumError(data.new_metadata('<zerosum>', 0),
+                             "Could not save zerosum match cache: {}".format(err), None)]
+    return []
+
+
+def plan_rewrites(entries, all_candidates, all_matches, options, groups, graph):
+    """Return (rewrites, matched postings count, new accounts) for the matches of all zerosum
+    accounts. rewrites records the matched postings of each transaction, so that each is only
+    rebuilt once: entry index -> {posting index: match_id}. new accounts are the accounts that
+    matched postings are moved to. The match graph is added to graph, if not None."""
+    zs_accounts_list = options['zerosum_accounts']
+    with_ids = options['match_metadata'] or options['link_transactions'] or graph is not None
+    rewrites = defaultdict(dict)
+    matched_postings_count = 0
+    new_accounts = set()
+    for zs_account, candidates in all_candidates.items():
+        matches = all_matches[zs_account]
+        for match in matches:
+            matched_postings_count += len(match)
+            match_id = None
+            if with_ids:
+                match_id = generate_match_id((entries[i], j) for i, j in (candidates[seq] for seq in match))
+            for seq in match:
+                i, j = candidates[seq]
+                rewrites[i][j] = match_id
+            if graph is not None:
+                graph.extend(match_edges(match, match_id, candidates, entries))
+        if zs_account in groups:
+            new_accounts.update(zs_accounts_list[entries[i].postings[j].account].target_account
+                                for match in matches for seq in match for i, j in [candidates[seq]])
+        elif matches:
+            new_accounts.add(zs_accounts_list[zs_account].target_account)
+    return rewrites, matched_postings_count, new_accounts
+
+
+def write_outputs(match_db, graph, stats_file, stats):
+    """Export graph to the match_db database, and save stats to stats_file, for those that are
+    set. Returns errors."""
+    errors = []
+    if match_db:
+        try:
+            export_match_graph(match_db, graph)
+        except (OSError, sqlite3.Error) as err:
+            errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                       "Could not export zerosum match graph: {}".format(err), None))
+    if stats_file:
+        try:
+            save_stats(stats_file, stats)
+        except OSError as err:
+            errors.append(ZerosumError(data.new_metadata('<zerosum>', 0),
+                                       "Could not save zerosum stats: {}".format(err), None))
+    return errors
+
+
+def zerosum(entries, options_map, config, stats=None, graph=None):
     """Insert entries for unmatched transactions in zero-sum accounts.
 
     Args:
@@ -219,11 +1595,16 @@ def zerosum(entries, options_map, config):  # noqa: C901
         date_range). matched_zerosum_account_name is optional, and can be left blank. If
         left blank, the name of the matched account is derived from the
         zerosum_account_name, by performing the string replacement specified by
-        'account_name_replace' (see below)
+        'account_name_replace' (see below). zerosum_account_name can also be a pattern matching
+        several accounts, such as 'Assets:Zero-Sum-Accounts:*'. See ZerosumAccounts
 
       - 'account_name_replace': tuple of two entries. See above
 
-      - 'tolerance': the maximum cost difference between two matching postings
+      - 'tolerance': the maximum cost difference between two matching postings. Postings only
+        match postings of the same currency
+
+      - 'currency_tolerance': dict of currency -> tolerance, overriding 'tolerance' for the
+        postings of that currency (eg: {'VMFXX': 0.0001}). Default {}
 
       - 'flag_unmatched': bool to control whether to flag unmatched
         transactions as warnings (default off)
@@ -238,137 +1619,294 @@ def zerosum(entries, options_map, config):  # noqa: C901
 
       - 'link_prefix': prefix to use in link names (default 'ZeroSum.')
 
+      - 'match_mode': how to choose between several candidate matches for a posting:
+        'greedy' (default) matches each posting with the earliest posting in its date range,
+        'closest' repeatedly matches the two closest-in-date postings, which pairs up
+        overlapping transfers of the same amount better
+
+      - 'max_subset_size': when greater than 1, postings left unmatched are further matched
+        against sets of up to this many postings that together sum up to zero with them (eg:
+        one transfer settled by several deposits). Default 1 (off). Keep this small: the cost
+        of the search grows quickly with it
+
+      - 'workers': number of processes to match zerosum accounts in parallel with. Each account
+        is matched independently, so this helps when there are several large accounts.
+        Default 0 (match in this process)
+
+      - 'shard_days': with 'workers', also split each zerosum account into shards of this many
+        days (at least its date range), matched in parallel, which helps when a single account
+        holds most postings. The matches found are the same. Only applies to greedy pairwise
+        matching, when there are no cached matches or budget for the account. Default None
+
+      - 'cache_file': path of a file to cache matches in, across runs. When set, only postings
+        that are new or changed, or that are within the date range of those, are matched
+        again. The cache is thrown away when the config changes. Default None (no cache)
+
+      - 'engine': 'numpy' to vectorize greedy matching with NumPy, when it is installed. The
+        matches found are the same. Default 'python'
+
+      - 'match_db': path of an SQLite database to export the match graph (see below) to, for
+        looking up matches without loading the ledger. See export_match_graph(). Default None
+
+      - 'match_groups': list of tuples of zerosum accounts whose postings are matched against
+        each other, such as both sides of a transfer booked to different zerosum accounts:
+        [('Assets:Zero-Sum-Accounts:Bank-Transfers', 'Assets:Zero-Sum-Accounts:Brokerage-Transfers')].
+        The postings of a group are matched as if they were in one account, over the largest of
+        its accounts' date ranges, and are moved to their own account's target. Default []
+
+      - 'auto_window': tune date ranges to the gaps between matched postings. 'report' reports
+        each account whose matches mostly fit in a smaller date range (see
+        'auto_window_percentile') as an error, so that its config can be tightened. 'apply'
+        (which needs 'cache_file') matches each account over the date range learned from the
+        run that created the cache, which used the configured date ranges. Default None (off)
+
+      - 'auto_window_percentile': percentage of matches the learned date range must fit.
+        Default 99
+
+      - 'max_comparisons', 'max_milliseconds': budget for matching each zerosum account (or
+        match group), as the number of postings compared and the time spent. Once either is
+        used up, matching the account stops, the postings it did not get to are left unmatched
+        and an error says how far it got. Such partial matches are not cached. Default None
+        (no limit)
+
       See example for more info.
 
-    Returns:
-      A tuple of entries and errors.
+      stats: optional dict, filled in with statistics about the run when given (when called
+        from Python rather than as a plugin):
 
-    """
+      - 'postings', 'matched_postings': number of postings in zerosum accounts, and of those
+        that were matched
+      - 'timings': seconds spent collecting postings, matching them (including the match cache),
+        applying the matches and creating Open directives
+      - 'accounts': zerosum account -> statistics, see account_stats(). 'cached_postings' is the
+        number of postings whose matches came from the match cache, and 'shards' the number of
+        shards of a sharded account (see 'shard_days')
 
-    def find_match():
-        '''Look forward to find a match, until date range is exceeded'''
-        max_date = txn.date + datetime.timedelta(days=date_range)
-
-        for j in range(i, len(zerosum_txns)):
-            t = zerosum_txns[j]
-            if t.date > max_date:
-                return None
-            for p in t.postings:
-                if p is posting:
-                    # Don't match with the same exact posting.
-                    continue
-                if (abs(p.units.number + posting.units.number) < tolerance
-                   and p.account == zs_account):
-                    return (p, t)
-        return None
+      If the ZEROSUM_STATS environment variable is set, these statistics are also written to
+      the file it names, as JSON.
 
-    def generate_match_id():
-        '''Generates a random string to be used as the match ID.'''
-        return ''.join(
-            random.choices(string.ascii_letters + string.digits, k=20))
+      graph: optional list, extended with the match graph when given: a MatchEdge from the
+        first posting of each match to each of the others, with the number of days between
+        them. Matches are given ids, as with 'match_metadata'.
 
-    if DEBUG:
-        # pr = cProfile.Profile()
-        # pr.enable()
-        start_time = time.time()
-
-    config_obj = literal_eval(config)  # TODO: error check
-    zs_accounts_list = config_obj.pop('zerosum_accounts', {})
-    (account_name_from, account_name_to) = config_obj.pop('account_name_replace', ('', ''))
-    tolerance = config_obj.pop('tolerance', DEFAULT_TOLERANCE)
-    match_metadata = config_obj.pop('match_metadata', False)
-    match_metadata_name = config_obj.pop('match_metadata_name', MATCHING_ID_STRING)
-    link_transactions = config_obj.pop('link_transactions', False)
-    link_prefix = config_obj.pop('link_prefix', LINK_PREFIX)
+    Returns:
+      A tuple of entries and errors.
 
-    new_accounts = set()
-    zerosum_postings_count = 0
-    match_count = 0
+    """
 
-    # Build zerosum_txns_all for all zs_accounts, so we iterate through entries only once (for performance)
-    zerosum_txns_all = defaultdict(list)
-    for i, entry in enumerate(entries):
-        if isinstance(entry, data.Transaction):
-            if link_transactions and type(entry.links) is frozenset:
-                entry = entry._replace(links=set(entry.links))  # unfreeze links set
-                entries[i] = entry
-
-            for zs_account, _ in zs_accounts_list.items():
-                if any(posting.account == zs_account for posting in entry.postings):
-                    zerosum_txns_all[zs_account].append(entry)
-                    zerosum_postings_count += 1
-                    # count doesn't account for multiple matching postings, but is close enough
-
-    for zs_account, (target_account, date_range) in zs_accounts_list.items():
-        if not target_account:
-            target_account = zs_account.replace(account_name_from, account_name_to)
-        zerosum_txns = zerosum_txns_all[zs_account]
-
-        # for each posting in each transaction, attempt to find a match. Replace account names in each each
-        # matched posting pair
-        for i in range(len(zerosum_txns)):
-            txn = zerosum_txns[i]
-            reprocess = True
-            while reprocess:  # necessary since this entry's postings changes under us when we find a match
-                for posting in txn.postings:
-                    reprocess = False
-                    if posting.account == zs_account:
-                        match = find_match()
-                        if match:
-                            # print('Match:', txn.date, match[1].date, match[1].date - txn.date,
-                            #         posting.units, posting.meta['lineno'], match[0].meta['lineno'])
-                            match_count += 1
-
-                            account_replace(txn,      posting,  target_account)
-                            account_replace(match[1], match[0], target_account)
-
-                            match_id = generate_match_id() if match_metadata or link_transactions else None
-
-                            if match_metadata:
-                                metadata_update(txn, posting, match_id, match_metadata_name)
-                                metadata_update(match[1], match[0], match_id, match_metadata_name)
-
-                            if link_transactions:
-                                transaction_update(txn, match_id, link_prefix)
-                                transaction_update(match[1], match_id, link_prefix)
-
-                            new_accounts.add(target_account)
-                            reprocess = True
-                            break
+    global _unmatched_handoff
+    _unmatched_handoff = None
+    start_time = time.time()
+    timings = {}
+    stats_file = os.environ.get(STATS_ENV_VAR)
+    if stats is None and stats_file:
+        stats = {}
+
+    open_accounts, errors = open_accounts_config(entries)
+    options = compile_config(config, open_accounts)
+    zs_accounts_list = options['zerosum_accounts']
+    if graph is None and options['match_db']:
+        graph = []
+    group_of, groups, group_errors = match_groups(options)
+    errors.extend(group_errors)
+    match_mode, engine, auto_window, option_errors = check_options(options)
+    errors.extend(option_errors)
+
+    entries = list(entries)  # entries are replaced below, never modified in place
+
+    all_candidates = collect_postings(entries, zs_accounts_list, group_of)
+    zerosum_postings_count = sum(len(candidates) for candidates in all_candidates.values())
+    timings['collect'] = time.time() - start_time
+
+    cache_file = options['cache_file']
+    match_cache_key = cache_key(options) if cache_file else None
+    match_cache = load_match_cache(cache_file, match_cache_key) if cache_file else None
+    all_stats = {} if stats is not None else None
+    jobs, all_matches, new_match_cache, learned_date_ranges = plan_matching(
+        entries, all_candidates, options, groups, match_mode, auto_window, match_cache, all_stats)
+    budgets = make_budgets(options, jobs)
+    all_matches.update(match_accounts(jobs, options['tolerance'], match_mode, options['max_subset_size'],
+                                      options['workers'], engine, options['currency_tolerance'], all_stats, budgets,
+                                      options['shard_days']))
+    errors.extend(budget_errors(budgets, new_match_cache))
+
+    if auto_window:
+        errors.extend(tune_date_ranges(all_candidates, all_matches, entries, options, groups, learned_date_ranges,
+                                       all_stats, auto_window))
+    if cache_file and jobs:
+        errors.extend(update_match_cache(cache_file, match_cache_key, new_match_cache, all_matches,
+                                         learned_date_ranges))
+    timings['match'] = time.time() - start_time - sum(timings.values())
+
+    rewrites, matched_postings_count, new_accounts = plan_rewrites(
+        entries, all_candidates, all_matches, options, groups, graph)
+
+    # Replace account names in matched postings, on copies of the matched transactions
+    for i, matched in rewrites.items():
+        entries[i] = _replace_matched_postings(entries[i], matched, zs_accounts_list, options)
+    timings['apply'] = time.time() - start_time - sum(timings.values())
 
     new_open_entries = common.create_open_directives(new_accounts, entries, meta_desc='<zerosum>')
+    timings['open'] = time.time() - start_time - sum(timings.values())
 
-    if link_transactions:
-        for i, entry in enumerate(entries):
-            if isinstance(entry, data.Transaction):
-                if len(entry.links) == 0:
-                    entries[i] = entry._replace(links=data.EMPTY_SET)
-                    # re-freeze empty sets
+    if stats is not None:
+        stats.update({'postings': zerosum_postings_count, 'matched_postings': matched_postings_count,
+                      'timings': timings, 'accounts': all_stats})
+    errors.extend(write_outputs(options['match_db'], graph, stats_file, stats))
 
     if DEBUG:
         elapsed_time = time.time() - start_time
         print("Zerosum [{:.1f}s]: {}/{} postings matched from {} transactions. {} new accounts added.".format(
-            elapsed_time, match_count*2, zerosum_postings_count, len(entries), len(new_open_entries)))
-        # pr.disable()
-        # pr.dump_stats('out.profile')
+            elapsed_time, matched_postings_count, zerosum_postings_count, len(entries), len(new_open_entries)))
+
+    new_entries = _Entries(entries + new_open_entries)
+    if options['flag_unmatched']:
+        _unmatched_handoff = (weakref.ref(new_entries), {i for candidates in all_candidates.values()
+                                                         for i, j in candidates if j not in rewrites.get(i, ())})
+    return new_entries, errors
 
-    return entries + new_open_entries, []
+
+def zerosum_stream(entries, config):
+    """Streaming variant of zerosum(), for ledgers too large to be held in memory, such as a
+    multi-decade archive export.
+
+    Consumes an iterable of date-sorted entries, and yields the resulting entries in the same
+    order. Only postings that are still within the date range of a zerosum account are kept
+    in memory (see WindowMatcher), along with the entries that follow the oldest of them.
+    Entries are yielded as soon as all their zerosum postings are either matched or out of
+    range. As with zerosum(), the input entries are not modified.
+
+    Matching is greedy and pairwise: 'match_mode', 'max_subset_size' and 'workers' are
+    ignored. Zerosum accounts configured in Open metadata are picked up as their Open entries
+    go by, but only accounts in the plugin's config can be in 'match_groups'. The Open
+    directive for a target account is yielded just before the first entry that uses it,
+    unless the account was already opened earlier in the stream.
+
+    Args:
+      entries: an iterable of date-sorted entry instances
+      config: see zerosum()
+    Yields:
+      Entry instances.
+    """
+    options = build_config(config)
+    group_of, groups, _ = match_groups(options)
+    matchers = defaultdict(dict)  # zerosum account or match group -> currency -> WindowMatcher
+    opened = set()
+    pending = collections.deque()  # [entry, count of undecided postings, {posting index: match_id}]
+
+    last_date = None
+    for entry in entries:
+        if entry.date != last_date:
+            last_date = entry.date
+            for account_matchers in matchers.values():
+                for matcher in account_matchers.values():
+                    for record, _ in matcher.expire(entry.date):
+                        record[1] -= 1
+
+        pending.append(_stream_match(entry, matchers, options, group_of, groups))
+        while pending and pending[0][1] == 0:
+            yield from _stream_finalize(pending.popleft(), opened, options)
+
+    while pending:
+        yield from _stream_finalize(pending.popleft(), opened, options)
+
+
+def _stream_match(entry, matchers, options, group_of, groups):
+    """Match the zerosum postings of entry against the open postings in matchers. group_of and
+    groups are as returned by match_groups(). Returns the record that zerosum_stream() tracks entry with."""
+    record = [entry, 0, {}]
+    if isinstance(entry, data.Open):
+        try:
+            account_config = open_entry_config(entry)
+        except ValueError:
+            account_config = None  # invalid metadata is reported by zerosum() only
+        if account_config is not None:
+            options['zerosum_accounts'].add(*account_config)
+    if not isinstance(entry, data.Transaction):
+        return record
+    with_ids = options['match_metadata'] or options['link_transactions']
+    for i, posting in enumerate(entry.postings):
+        zs_account = options['zerosum_accounts'][posting.account]
+        if zs_account is None:
+            continue
+        group = group_of.get(posting.account)
+        if group is not None:
+            zs_account = groups[group]
+        account_matchers = matchers[group or posting.account]
+        currency = posting.units.currency
+        matcher = account_matchers.get(currency)
+        if matcher is None:
+            tolerance = options['tolerance'] if zs_account.tolerance is None else zs_account.tolerance
+            matcher = account_matchers[currency] = WindowMatcher(
+                zs_account.date_range, options['currency_tolerance'].get(currency, tolerance))
+        match = matcher.add(entry.date, posting.units.number, (record, i))
+        if match is None:
+            record[1] += 1
+        else:
+            match_record, match_index = match
+            match_id = generate_match_id([(entry, i), (match_record[0], match_index)]) if with_ids else None
+            record[2][i] = match_id
+            match_record[2][match_index] = match_id
+            match_record[1] -= 1
+    return record
+
+
+def _stream_finalize(record, opened, options):
+    """Return the entries to yield for a record whose zerosum postings are all decided."""
+    entry, _, matched = record
+    if isinstance(entry, data.Open):
+        opened.add(entry.account)
+    if not matched:
+        return [entry]
+    new_entry = _replace_matched_postings(entry, matched, options['zerosum_accounts'], options)
+    new_opens = []
+    for index in matched:
+        account = new_entry.postings[index].account
+        if account not in opened:
+            opened.add(account)
+            new_opens.append(data.Open(data.new_metadata('<zerosum>', 0), entry.date, account, None, None))
+    return new_opens + [new_entry]
+
+
+def _replace_matched_postings(entry, matched, zs_accounts, options):
+    """Return a copy of entry, with the postings in matched (a dict of posting index ->
+    match_id) moved to their target accounts, and match ids added as configured."""
+    postings = list(entry.postings)
+    links = set()
+    for index, match_id in matched.items():
+        posting = postings[index]
+        meta = posting.meta
+        if match_id and options['match_metadata']:
+            meta = dict(meta or {}, **{options['match_metadata_name']: match_id})
+        if match_id and options['link_transactions']:
+            links.add(options['link_prefix'] + match_id)
+        postings[index] = posting._replace(account=zs_accounts[posting.account][0], meta=meta)
+    if links:
+        return entry._replace(postings=postings, links=frozenset(entry.links or ()) | links)
+    return entry._replace(postings=postings)
 
 
 def flag_unmatched(entries, unused_options_map, config):
-    '''Iterate again, to flag unmatched entries'''
+    '''Flag transactions with postings left unmatched in zerosum accounts.
+
+    When run right after zerosum() as a plugin, on the entries it returned, this reuses what
+    zerosum() found and touches only the flagged transactions. Otherwise, it scans all entries
+    for postings still in zerosum accounts.'''
 
-    config_obj = literal_eval(config)
-    if not config_obj.get('flag_unmatched'):
+    global _unmatched_handoff
+    handoff, _unmatched_handoff = _unmatched_handoff, None
+    if not compile_config(config)['flag_unmatched']:
         return (entries, [])
 
-    new_entries = []
-    zs_accounts = config_obj['zerosum_accounts'].keys()
-    for entry in entries:
-        if isinstance(entry, data.Transaction):
-            for posting in entry.postings:
-                if posting.account in zs_accounts:
-                    entry = entry._replace(flag=flags.FLAG_WARNING)
-                    break
-        new_entries.append(entry)
+    if handoff is not None and handoff[0]() is entries:
+        unmatched = handoff[1]
+    else:
+        zs_accounts = compile_config(config, open_accounts_config(entries)[0])['zerosum_accounts']
+        unmatched = [i for i, entry in enumerate(entries)
+                     if isinstance(entry, data.Transaction) and
+                     any(zs_accounts[posting.account] is not None for posting in entry.postings)]
+
+    new_entries = list(entries)
+    for i in unmatched:
+        new_entries[i] = new_entries[i]._replace(flag=flags.FLAG_WARNING)
     return new_entries, []